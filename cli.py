@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# cli.py - Единая точка входа: python cli.py <команда> [параметры]
+#
+# Модули команд (requests, sing-box, NumPy и т.д.) импортируются только
+# при вызове своей команды, поэтому короткие запуски стартуют быстро.
+
+import os
+import sys
+import argparse
+
+COMMANDS = {
+    'batch': 'пакетная проверка in/ -> out/ (как test_proxies.py)',
+    'daemon': 'демон: горячий пул рабочих прокси ([daemon])',
+    'merge': 'объединить частичные результаты шардов',
+    'detail': 'детальная проверка по одному прокси с гео (deep_check)',
+    'export': 'клиентский конфиг sing-box из готовых списков',
+    'history': 'показатели прокси из истории задержек',
+    'bench': 'время запуска команд по -X importtime',
+}
+
+
+def cmd_batch(argv):
+    from test_proxies import main
+    main(argv)
+
+
+def cmd_daemon(argv):
+    from test_proxies import main
+    main(['--daemon'] + argv)
+
+
+def cmd_merge(argv):
+    from test_proxies import main
+    main(['--merge'] + argv)
+
+
+def cmd_detail(argv):
+    from deep_check import main
+    main(argv)
+
+
+def cmd_history(argv):
+    from history import main
+    main(argv)
+
+
+def cmd_export(argv):
+    parser = argparse.ArgumentParser(prog='cli.py export',
+                                     description='Клиентский конфиг sing-box (urltest + selector) из списков прокси')
+    parser.add_argument('files', nargs='+', help='списки рабочих прокси, например out/top_mixed.txt')
+    parser.add_argument('--config', default='option.ini', help='файл настроек')
+    parser.add_argument('--count', type=int, help='сколько прокси взять (по умолчанию [export] count)')
+    parser.add_argument('-o', '--output', default='out/singbox_export.json', help='куда записать конфиг')
+    args = parser.parse_args(argv)
+
+    import json
+    from test_proxies import FastProxyTester
+    tester = FastProxyTester(args.config)
+
+    urls = []
+    for path in args.files:
+        urls.extend(tester._read_lines(path) or [])
+    urls = list(dict.fromkeys(urls))
+
+    # Порядок файла (out/top_* уже отсортированы) или score из истории
+    if tester.history:
+        scores = tester.history.scores()
+        unknown = {'score': tester.max_delay}
+        urls.sort(key=lambda url: scores.get(tester._history_key(url), unknown)['score'])
+    ranked = [(url, None) for url in urls[:args.count or tester.export_count]]
+
+    config = tester.create_client_config(ranked)
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    print(f"📦 {args.output}: {len(config['outbounds'][1]['outbounds'])} прокси в urltest")
+
+
+def cmd_bench(argv):
+    parser = argparse.ArgumentParser(prog='cli.py bench',
+                                     description='Время импорта каждой команды (python -X importtime ... --help)')
+    parser.add_argument('--runs', type=int, default=3, help='запусков на команду (берётся лучший)')
+    parser.add_argument('--top', type=int, default=3, help='сколько самых тяжёлых модулей показать')
+    parser.add_argument('--budget', type=float, default=100,
+                        help='бюджет импорта команды, мс: при превышении код выхода 1 (0 - без проверки)')
+    parser.add_argument('commands', nargs='*', help='какие команды мерить (по умолчанию все)')
+    args = parser.parse_args(argv)
+
+    import time
+    import subprocess
+
+    print(f"{'Команда':<10}{'Импорт, мс':>12}{'Запуск, мс':>12}  Тяжёлые модули")
+    over = []
+    for command in args.commands or [c for c in COMMANDS if c != 'bench']:
+        best = None
+        for _ in range(max(args.runs, 1)):
+            start = time.perf_counter()
+            completed = subprocess.run(
+                [sys.executable, '-X', 'importtime', os.path.abspath(__file__), command, '--help'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, encoding='utf-8')
+            wall = (time.perf_counter() - start) * 1000
+            modules = _parse_importtime(completed.stderr)
+            total = sum(modules.values()) / 1000
+            if best is None or wall < best[1]:
+                best = (total, wall, modules)
+
+        total, wall, modules = best
+        heavy = sorted(modules.items(), key=lambda item: -item[1])[:args.top]
+        heavy_text = ', '.join(f"{name} {micros / 1000:.0f}" for name, micros in heavy)
+        print(f"{command:<10}{total:>12.1f}{wall:>12.1f}  {heavy_text}")
+        if args.budget > 0 and total > args.budget:
+            over.append(command)
+    
+    if over:
+        print(f"❌ Бюджет импорта {args.budget:.0f} мс превышен: {', '.join(over)}")
+        sys.exit(1)
+    if args.budget > 0:
+        print(f"✅ Все команды в бюджете импорта {args.budget:.0f} мс")
+
+
+def _parse_importtime(stderr):
+    """Накопленное время (мкс) модулей верхнего уровня из вывода -X importtime"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        parts = line.split('|')
+        if len(parts) != 3:
+            continue
+        cumulative, name = parts[1].strip(), parts[2]
+        # Отступ в два пробела на уровень вложенности: верхний уровень - один пробел
+        if cumulative.isdigit() and name.startswith(' ') and not name.startswith('  '):
+            modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help') or argv[0] not in COMMANDS:
+        if argv and argv[0] not in ('-h', '--help'):
+            print(f"❌ Неизвестная команда: {argv[0]}\n")
+        print("Использование: python cli.py <команда> [параметры]\n")
+        for name, help_text in COMMANDS.items():
+            print(f"  {name:<9}{help_text}")
+        print("\nПараметры команды: python cli.py <команда> --help")
+        sys.exit(0 if not argv or argv[0] in ('-h', '--help') else 2)
+
+    globals()[f"cmd_{argv[0]}"](argv[1:])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# daemon.py - Режим демона (--daemon): горячий пул рабочих прокси
+#
+# Каждый цикл перепроверяет текущий пул и добавляет немного новых кандидатов
+# из in/. Пул отдаётся по HTTP (/pool, /pool.json) и пишется в файл с атомарной
+# заменой, так что потребители всегда видят список, проверенный минуты назад.
+
+import os
+import json
+import time
+import random
+import threading
+from collections import deque
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class PoolDaemon:
+    """Непрерывная перепроверка пула поверх FastProxyTester"""
+
+    def __init__(self, tester):
+        self.tester = tester
+        config = tester.config
+        self.interval = config.getfloat('daemon', 'interval', fallback=120)
+        self.jitter = config.getfloat('daemon', 'jitter', fallback=0.2)
+        self.new_per_cycle = config.getint('daemon', 'new_per_cycle', fallback=50)
+        self.rescan = config.getfloat('daemon', 'rescan', fallback=600)
+        self.fail_limit = config.getint('daemon', 'fail_limit', fallback=2)
+        self.dead_retry = config.getfloat('daemon', 'dead_retry', fallback=3600)
+        self.pool_file = config.get('daemon', 'pool_file', fallback='out/pool.txt')
+        self.port = config.getint('daemon', 'port', fallback=0)
+        self.listen = config.get('daemon', 'listen', fallback='127.0.0.1')
+
+        self._lock = threading.Lock()
+        self.pool = {}           # url -> {'delay', 'checked', 'fails'}
+        self._candidates = deque()
+        self._queued = set()
+        self._rejected = {}      # url -> когда отбракован
+        self._last_scan = 0
+        self._server = None
+
+    # ---------- Источники ----------
+
+    def _load_pool_file(self):
+        """Прошлый пул с диска - первым делом на перепроверку"""
+        if not os.path.exists(self.pool_file):
+            return
+        with open(self.pool_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                url = line.strip()
+                if url:
+                    self.pool[url] = {'delay': None, 'checked': 0, 'fails': 0}
+        print(f"♻️  Пул из {self.pool_file}: {len(self.pool)} прокси")
+
+    def _scan_inputs(self):
+        """Новые кандидаты из in/: не в пуле, не в очереди и не отбракованы недавно"""
+        now = time.time()
+        self._last_scan = now
+        self._rejected = {url: ts for url, ts in self._rejected.items() if now - ts < self.dead_retry}
+
+        lines = []
+        for file in sorted(Path('in').glob('*')):
+            if file.is_file():
+                lines.extend(self.tester._read_lines(str(file)) or [])
+        order = self.tester._schedule(lines)
+
+        added = 0
+        for i in order:
+            url = lines[i]
+            if url in self.pool or url in self._queued or url in self._rejected:
+                continue
+            self._candidates.append(url)
+            self._queued.add(url)
+            added += 1
+        print(f"📥 Новых кандидатов: {added}, в очереди: {len(self._candidates)}")
+
+    # ---------- Цикл ----------
+
+    def _test(self, urls):
+        """Проверить список пачками; результат - {url: задержка} рабочих"""
+        working = {}
+        batches = self.tester._batches(urls, list(range(len(urls))))
+        start = 0
+        for batch_num, batch_indices in enumerate(batches):
+            batch = [urls[idx] for idx in batch_indices]
+            for i, url, delay in self.tester.test_batch_proxies(batch, batch_num + 1, len(batches), start):
+                working[url] = delay
+            start += len(batch)
+        return working
+
+    def cycle(self):
+        """Один проход: перепроверка пула + порция кандидатов"""
+        if time.time() - self._last_scan >= self.rescan:
+            self._scan_inputs()
+
+        fresh = []
+        while self._candidates and len(fresh) < self.new_per_cycle:
+            url = self._candidates.popleft()
+            self._queued.discard(url)
+            fresh.append(url)
+
+        with self._lock:
+            known = list(self.pool)
+        print(f"\n🔁 Цикл: пул {len(known)}, новых {len(fresh)}")
+        working = self._test(known + fresh)
+
+        now = time.time()
+        demoted = promoted = 0
+        with self._lock:
+            for url in known:
+                entry = self.pool[url]
+                if url in working:
+                    entry.update(delay=working[url], checked=now, fails=0)
+                    continue
+                entry['fails'] += 1
+                if entry['fails'] >= self.fail_limit or entry['delay'] is None:
+                    del self.pool[url]
+                    self._rejected[url] = now
+                    demoted += 1
+            for url in fresh:
+                if url in working:
+                    self.pool[url] = {'delay': working[url], 'checked': now, 'fails': 0}
+                    promoted += 1
+                else:
+                    self._rejected[url] = now
+            # Выходные IP - только для тех, кто остался в пуле
+            self.tester.egress_ips = {url: ip for url, ip in self.tester.egress_ips.items() if url in self.pool}
+
+        self.tester.metrics.set('pool_size', len(self.pool))
+        print(f"📊 Пул: {len(self.pool)} (+{promoted}, -{demoted})")
+        self._publish()
+
+    def ranked(self):
+        """Пул от быстрых к медленным; прокси с последней неудачей - в конце"""
+        with self._lock:
+            items = [(url, dict(entry)) for url, entry in self.pool.items() if entry['delay'] is not None]
+        return sorted(items, key=lambda item: (item[1]['fails'],
+                                               self.tester._rank_delay(item[0], item[1]['delay'])))
+
+    def _publish(self):
+        """Атомарная замена файла пула: читатели видят либо старый, либо новый список"""
+        directory = os.path.dirname(self.pool_file) or '.'
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.pool_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(url for url, entry in self.ranked()))
+        os.replace(tmp_path, self.pool_file)
+
+        if self.tester.export_singbox:
+            ranked = [(url, entry['delay']) for url, entry in self.ranked()]
+            client_file = f"{os.path.splitext(self.pool_file)[0]}.singbox.json"
+            self.tester._write_client_config(client_file, ranked)
+
+    # ---------- HTTP ----------
+
+    def start_server(self):
+        if self.port <= 0:
+            return
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                ranked = daemon.ranked()
+                if path in ('/', '/pool'):
+                    body = '\n'.join(url for url, entry in ranked).encode('utf-8')
+                    content_type = 'text/plain; charset=utf-8'
+                elif path == '/pool.json':
+                    body = json.dumps([{'url': url, 'delay': round(entry['delay'], 1),
+                                        'checked': round(entry['checked']), 'fails': entry['fails'],
+                                        'egress': daemon.tester.egress_ips.get(url)}
+                                       for url, entry in ranked], ensure_ascii=False).encode('utf-8')
+                    content_type = 'application/json'
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.listen, self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"🌐 Пул: http://{self.listen}:{self.port}/pool")
+
+    def run(self, max_cycles=0):
+        """Циклы до Ctrl+C (или max_cycles, если задано)"""
+        print("🛰️  РЕЖИМ ДЕМОНА")
+        print(f"🔁 Интервал: {self.interval:.0f} сек ±{self.jitter * 100:.0f}%, новых за цикл: {self.new_per_cycle}")
+        self.tester.metrics.define('pool_size', 'gauge', 'Рабочих прокси в пуле демона')
+        self.tester.start_metrics()
+        self.tester._load_history_scores()
+        self._load_pool_file()
+        self.start_server()
+
+        cycles = 0
+        try:
+            while True:
+                started = time.time()
+                self.cycle()
+                cycles += 1
+                if max_cycles and cycles >= max_cycles:
+                    break
+                # Случайный разброс интервала, чтобы несколько демонов не били в такт
+                delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+                time.sleep(max(delay - (time.time() - started), 1))
+        except KeyboardInterrupt:
+            print("\n⏹️  Остановка демона")
+        finally:
+            if self._server:
+                self._server.shutdown()
+            self.tester._finish_history()
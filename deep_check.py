@@ -1,19 +1,19 @@
 #!/usr/bin/env python3
 # simple_local_check.py - Упрощенная проверка с детальной отладкой
  
-import json
 import time
-import requests
+import json
 import subprocess
-import tempfile
 import os
 import sys
 import configparser
 from datetime import datetime
 from urllib.parse import urlparse, parse_qs
+
+from launch import ConfigHandle, LogDrainer, dump_config, write_debug
  
 class SimpleLocalChecker:
-    def __init__(self, config_file='option.ini'):
+    def __init__(self, config_file='option.ini', debug_dir=None):
         self.config = configparser.ConfigParser()
         self.config.read(config_file, encoding='utf-8')
         
@@ -32,8 +32,11 @@ class SimpleLocalChecker:
         self.test_url = "https://httpbin.org/ip"
         self.test_timeout = 5
         
-        # Для отладки
-        self.debug = True
+        # Для отладки: конфиги и логи ошибок пишутся только в эту папку (--debug ПАПКА)
+        self.debug_dir = debug_dir
+        
+        # Гео по выходному IP: прокси с одним выходом (CDN, общий backend) - один запрос
+        self._geo_cache = {}
         
     def parse_vless(self, url, parsed):
         """Простой парсер VLESS"""
@@ -107,6 +110,7 @@ class SimpleLocalChecker:
     
     def test_connection(self, local_port):
         """Простой тест соединения"""
+        import requests
         proxy_dict = {
             'http': f'socks5://127.0.0.1:{local_port}',
             'https': f'socks5://127.0.0.1:{local_port}'
@@ -141,6 +145,7 @@ class SimpleLocalChecker:
     
     def check_proxy(self, proxy_url, port):
         """Проверяем одну прокси"""
+        import requests
         print(f"\n🔍 [{port-16000+1}] {proxy_url[:60]}...")
         
         # Парсим
@@ -154,12 +159,11 @@ class SimpleLocalChecker:
         # Создаем конфиг
         config = self.create_simple_config(proxy_config, port)
         
-        # Сохраняем конфиг для отладки
-        config_filename = f"debug_{port}.json"
-        with open(config_filename, 'w', encoding='utf-8') as f:
-            json.dump(config, f, indent=2)
-        
-        print(f"    📄 Конфиг: {config_filename}")
+        # Конфиг передаётся в памяти; копия для отладки - только по запросу
+        config_handle = ConfigHandle(dump_config(config))
+        debug_file = write_debug(self.debug_dir, f"debug_{port}.json", config)
+        if debug_file:
+            print(f"    📄 Конфиг: {debug_file}")
         
         # Запускаем sing-box
         startupinfo = None
@@ -168,15 +172,17 @@ class SimpleLocalChecker:
             startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
             startupinfo.wShowWindow = subprocess.SW_HIDE
         
-        process = subprocess.Popen(
-            [self.singbox_path, 'run', '-c', config_filename],
+        process = config_handle.spawn(
+            self.singbox_path,
+            startupinfo,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            startupinfo=startupinfo,
             text=True,
             encoding='utf-8',
+            errors='replace',
             bufsize=1
         )
+        drainer = LogDrainer(process)
         
         # Ждем запуска и читаем логи
         print("    ⏳ Запускаю sing-box...")
@@ -184,14 +190,15 @@ class SimpleLocalChecker:
         
         # Проверяем запустился ли
         if process.poll() is not None:
-            stderr = process.stderr.read()
+            drainer.join()
+            stderr = drainer.text()
             print(f"    ❌ Sing-box упал: {stderr[:100]}")
             
             # Сохраняем логи
-            with open(f"error_{port}.log", 'w') as f:
-                f.write(stderr)
+            write_debug(self.debug_dir, f"error_{port}.log", stderr)
             
             process.terminate()
+            config_handle.close()
             return None
         
         print("    ✅ Sing-box запущен")
@@ -206,23 +213,24 @@ class SimpleLocalChecker:
         except:
             process.kill()
         
-        # Удаляем временные файлы
-        try:
-            os.unlink(config_filename)
-        except:
-            pass
+        # Закрываем конфиг в памяти
+        config_handle.close()
         
         if success and ip:
-            # Дополнительная проверка через ipapi.co
+            # Дополнительная проверка через ipapi.co (один раз на выходной IP)
             try:
-                geo_response = requests.get(
-                    f"https://ipapi.co/{ip}/json/",
-                    timeout=3
-                )
-                if geo_response.status_code == 200:
-                    geo_data = geo_response.json()
+                if ip in self._geo_cache:
+                    print("    ♻️  Гео из кэша: этот выходной IP уже проверен")
+                else:
+                    geo_response = requests.get(
+                        f"https://ipapi.co/{ip}/json/",
+                        timeout=3
+                    )
+                    self._geo_cache[ip] = geo_response.json() if geo_response.status_code == 200 else None
+                geo_data = self._geo_cache[ip]
+                if geo_data:
                     country = geo_data.get('country_name', 'Unknown')
-                    isp = geo_data.get('org', '')[:30]
+                    isp = (geo_data.get('org') or '')[:30]
                     
                     print(f"    🌍 Страна: {country}")
                     print(f"    🏢 Провайдер: {isp}")
@@ -249,13 +257,37 @@ class SimpleLocalChecker:
             'isp': 'Unknown'
         }
     
-    def run(self, input_file):
+    def load_egress(self, input_file, egress_file=None):
+        """Выходные IP из out/egress_<файл>.json пакетной проверки: url прокси -> IP.
+        Без явного пути ищется рядом со списком; прокси без IP ('unknown') не группируются"""
+        if not egress_file:
+            name = os.path.splitext(os.path.basename(input_file))[0]
+            egress_file = os.path.join(os.path.dirname(input_file), f"egress_{name}.json")
+            if not os.path.exists(egress_file):
+                return {}
+        try:
+            with open(egress_file, 'r', encoding='utf-8') as f:
+                groups = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️  Не удалось прочитать {egress_file}: {e}")
+            return {}
+        
+        egress = {entry['url']: ip for ip, entries in groups.items() if ip != 'unknown' for entry in entries}
+        print(f"🌐 {egress_file}: {len(set(egress.values()))} выходных IP на {len(egress)} прокси")
+        return egress
+    
+    def run(self, input_file, egress_file=None):
         """Запуск проверки"""
         print(f"\n📄 Читаю файл: {input_file}")
         
         with open(input_file, 'r', encoding='utf-8') as f:
             lines = [line.strip() for line in f if line.strip()]
         
+        # Прокси с общим выходным IP проверяются один раз: первый рабочий из группы - представитель,
+        # остальные получают его результат. Если представитель не ответил, проверяется следующий
+        egress = self.load_egress(input_file, egress_file)
+        checked_exits = {}
+        
         print(f"📊 Всего прокси: {len(lines)}")
         print(f"🔧 Тестовый URL: {self.test_url}")
         print(f"⏱️  Таймаут: {self.test_timeout}с")
@@ -267,21 +299,41 @@ class SimpleLocalChecker:
         for i, proxy_url in enumerate(lines):
             print(f"\n[{i+1}/{len(lines)}] ", end="")
             
+            exit_ip = egress.get(proxy_url)
+            representative = checked_exits.get(exit_ip)
+            if representative:
+                print(f"♻️  {proxy_url[:60]}...")
+                print(f"    ♻️  Выход {exit_ip} уже проверен: {representative['proxy'][:50]}...")
+                result = dict(representative, proxy=proxy_url)
+                successful.append(result)
+                
+                # Дописываем в файл представителя
+                filepath = os.path.join('checked', result['filename'])
+                with open(filepath, 'a', encoding='utf-8') as f:
+                    f.write(result['proxy'] + "\n")
+                print(f"    💾 Добавлено: {filepath}")
+                continue
+            
             result = self.check_proxy(proxy_url, port)
             port += 1
             
             if result:
                 successful.append(result)
+                if exit_ip:
+                    checked_exits[exit_ip] = result
                 
                 # Сохраняем сразу
                 os.makedirs('checked', exist_ok=True)
                 filepath = os.path.join('checked', result['filename'])
                 
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    f.write(f"# Проверено: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                    f.write(f"# IP: {result['ip']}\n")
-                    f.write(f"# Страна: {result['country']}\n")
-                    f.write(f"# Провайдер: {result['isp']}\n\n")
+                # Файл того же выхода мог быть создан минуту назад - дописываем, а не затираем
+                is_new = not os.path.exists(filepath)
+                with open(filepath, 'a', encoding='utf-8') as f:
+                    if is_new:
+                        f.write(f"# Проверено: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+                        f.write(f"# IP: {result['ip']}\n")
+                        f.write(f"# Страна: {result['country']}\n")
+                        f.write(f"# Провайдер: {result['isp']}\n\n")
                     f.write(result['proxy'] + "\n")
                 
                 print(f"    💾 Сохранено: {filepath}")
@@ -313,19 +365,37 @@ class SimpleLocalChecker:
         
         return successful
 
-def main():
+def main(argv=None):
+    args = list(sys.argv[1:] if argv is None else argv)
+    if '-h' in args or '--help' in args:
+        print("Использование: python deep_check.py <файл_с_прокси> [--debug ПАПКА] [--egress ФАЙЛ]")
+        print("  --egress  группы выходных IP (по умолчанию egress_<файл>.json рядом со списком)")
+        return
+    
     print("🔧 ПРОСТАЯ ЛОКАЛЬНАЯ ПРОВЕРКА ПРОКСИ")
     print("=" * 60)
     
-    if len(sys.argv) < 2:
-        print("Использование: python simple_local_check.py <файл_с_прокси>")
-        print("Пример: python simple_local_check.py proxies.txt")
+    debug_dir = None
+    if '--debug' in args:
+        position = args.index('--debug')
+        debug_dir = args[position + 1] if position + 1 < len(args) else 'debug'
+        del args[position:position + 2]
+    
+    egress_file = None
+    if '--egress' in args:
+        position = args.index('--egress')
+        egress_file = args[position + 1] if position + 1 < len(args) else None
+        del args[position:position + 2]
+    
+    if not args:
+        print("Использование: python deep_check.py <файл_с_прокси> [--debug ПАПКА] [--egress ФАЙЛ]")
+        print("Пример: python deep_check.py proxies.txt")
         sys.exit(1)
     
-    input_file = sys.argv[1]
+    input_file = args[0]
     
-    checker = SimpleLocalChecker()
-    checker.run(input_file)
+    checker = SimpleLocalChecker(debug_dir=debug_dir)
+    checker.run(input_file, egress_file)
     
     print("\n🎉 Готово!")
 
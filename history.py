@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# history.py - Хранилище истории задержек и векторный расчёт здоровья прокси
+#
+# Формат: папка с колонками, которые только дописываются в конец
+#   ts.f64   - время замера (unix, float64)
+#   pid.u32  - номер прокси (uint32)
+#   lat.f32  - задержка в мс (float32), NaN - прокси не работал
+#   keys.tsv - номер прокси -> ключ идентичности и последняя ссылка
+# Расчёт через NumPy, если он установлен, иначе - через array и обычные циклы.
+
+import os
+import sys
+import math
+import time
+import array
+import threading
+
+# NumPy подгружается при первом расчёте: сам импорт занимает ~0.1 с
+np = None
+
+
+def _numpy():
+    """Модуль numpy или None, если он не установлен"""
+    global np
+    if np is None:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            np = False
+    return np or None
+
+COLUMNS = (('ts', 'd', 'f64'), ('pid', 'I', 'u32'), ('lat', 'f', 'f32'))
+
+
+class LatencyHistory:
+    """Append-only история замеров по всем запускам"""
+
+    def __init__(self, path='history', ewma_alpha=0.3, max_age_days=14, max_delay=3000):
+        self.path = path
+        self.ewma_alpha = ewma_alpha
+        self.max_age = max_age_days * 86400
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._keys = {}   # ключ -> pid
+        self._urls = []   # pid -> последняя ссылка
+        os.makedirs(path, exist_ok=True)
+        self._load_keys()
+        self._repair()
+
+    def _column_path(self, name, suffix):
+        return os.path.join(self.path, f"{name}.{suffix}")
+
+    def _load_keys(self):
+        keys_path = os.path.join(self.path, 'keys.tsv')
+        if not os.path.exists(keys_path):
+            return
+        with open(keys_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t', 2)
+                if len(parts) < 3:
+                    continue
+                pid = int(parts[0])
+                self._keys[parts[1]] = pid
+                while len(self._urls) <= pid:
+                    self._urls.append('')
+                self._urls[pid] = parts[2]
+
+    def _repair(self):
+        """После аварийного завершения колонки могут быть разной длины - обрезаем"""
+        lengths = []
+        for name, code, suffix in COLUMNS:
+            column_path = self._column_path(name, suffix)
+            size = os.path.getsize(column_path) if os.path.exists(column_path) else 0
+            lengths.append(size // array.array(code).itemsize)
+        rows = min(lengths)
+        for (name, code, suffix), length in zip(COLUMNS, lengths):
+            if length != rows:
+                with open(self._column_path(name, suffix), 'r+b') as f:
+                    f.truncate(rows * array.array(code).itemsize)
+
+    def record(self, samples, timestamp=None):
+        """samples: [(ключ, ссылка, задержка или None)] одного замера"""
+        if not samples:
+            return
+        timestamp = timestamp or time.time()
+        columns = {name: array.array(code) for name, code, _ in COLUMNS}
+        new_keys = []
+
+        with self._lock:
+            for key, url, delay in samples:
+                pid = self._keys.get(key)
+                if pid is None:
+                    pid = len(self._urls)
+                    self._keys[key] = pid
+                    self._urls.append(url)
+                    new_keys.append((pid, key, url))
+                else:
+                    self._urls[pid] = url
+                columns['ts'].append(timestamp)
+                columns['pid'].append(pid)
+                columns['lat'].append(float('nan') if delay is None else delay)
+
+            if new_keys:
+                with open(os.path.join(self.path, 'keys.tsv'), 'a', encoding='utf-8') as f:
+                    for pid, key, url in new_keys:
+                        f.write(f"{pid}\t{key}\t{url}\n")
+            for name, code, suffix in COLUMNS:
+                with open(self._column_path(name, suffix), 'ab') as f:
+                    columns[name].tofile(f)
+
+    def _read_columns(self):
+        data = {}
+        for name, code, suffix in COLUMNS:
+            column_path = self._column_path(name, suffix)
+            if _numpy() is not None:
+                dtype = {'d': np.float64, 'I': np.uint32, 'f': np.float32}[code]
+                data[name] = np.fromfile(column_path, dtype=dtype) if os.path.exists(column_path) \
+                    else np.zeros(0, dtype=dtype)
+            else:
+                column = array.array(code)
+                if os.path.exists(column_path):
+                    with open(column_path, 'rb') as f:
+                        column.frombytes(f.read())
+                data[name] = column
+        rows = min(len(column) for column in data.values())
+        return {name: column[:rows] for name, column in data.items()}
+
+    def scores(self, now=None):
+        """{ключ: {'n', 'uptime', 'ewma', 'p95', 'jitter', 'score'}} по всем известным прокси.
+        score - ожидаемая задержка с штрафом за нестабильность, меньше - лучше"""
+        now = now or time.time()
+        with self._lock:
+            columns = self._read_columns()
+            keys = {pid: key for key, pid in self._keys.items()}
+
+        if _numpy() is not None:
+            stats = self._scores_numpy(columns, now)
+        else:
+            stats = self._scores_python(columns, now)
+
+        result = {}
+        for pid, values in stats.items():
+            key = keys.get(pid)
+            if key is None:
+                continue
+            values['score'] = self._score(values)
+            values['url'] = self._urls[pid]
+            result[key] = values
+        return result
+
+    def _score(self, values):
+        ewma = values['ewma'] if not math.isnan(values['ewma']) else self.max_delay
+        jitter = values['jitter'] if not math.isnan(values['jitter']) else 0.0
+        return ewma + jitter + (1.0 - values['uptime']) * self.max_delay
+
+    def rank(self, values, delay):
+        """Score с учётом свежего замера поверх истории до запуска (для top-K)"""
+        if not values:
+            return delay
+        ewma = delay if math.isnan(values['ewma']) else \
+            self.ewma_alpha * delay + (1.0 - self.ewma_alpha) * values['ewma']
+        jitter = values['jitter'] if not math.isnan(values['jitter']) else 0.0
+        uptime = (values['uptime'] * values['n'] + 1) / (values['n'] + 1)
+        return ewma + jitter + (1.0 - uptime) * self.max_delay
+
+    def _scores_numpy(self, columns, now):
+        ts, pid, lat = columns['ts'], columns['pid'], columns['lat'].astype(np.float64)
+        keep = ts >= now - self.max_age
+        ts, pid, lat = ts[keep], pid[keep], lat[keep]
+        if not len(pid):
+            return {}
+
+        size = int(pid.max()) + 1
+        total = np.bincount(pid, minlength=size)
+        ok = ~np.isnan(lat)
+        ok_pid, ok_lat, ok_ts = pid[ok], lat[ok], ts[ok]
+        ok_count = np.bincount(ok_pid, minlength=size)
+
+        # Среднее и разброс (jitter = стандартное отклонение) успешных замеров
+        sum_lat = np.bincount(ok_pid, weights=ok_lat, minlength=size)
+        sum_sq = np.bincount(ok_pid, weights=ok_lat * ok_lat, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = sum_lat / ok_count
+            jitter = np.sqrt(np.maximum(sum_sq / ok_count - mean * mean, 0))
+
+        # EWMA: сортировка по (прокси, время), вес (1-a)^(номер с конца в группе)
+        order = np.lexsort((ok_ts, ok_pid))
+        s_pid, s_lat = ok_pid[order], ok_lat[order]
+        starts = np.concatenate(([0], np.cumsum(ok_count)[:-1]))
+        position = np.arange(len(s_pid)) - starts[s_pid]
+        from_end = ok_count[s_pid] - 1 - position
+        weights = (1.0 - self.ewma_alpha) ** from_end
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ewma = np.bincount(s_pid, weights=weights * s_lat, minlength=size) / \
+                np.bincount(s_pid, weights=weights, minlength=size)
+
+        # p95: сортировка по (прокси, задержка) и выбор индекса внутри группы
+        by_lat = np.lexsort((ok_lat, ok_pid))
+        sorted_lat = ok_lat[by_lat]
+        p95 = np.full(size, np.nan)
+        has_ok = ok_count > 0
+        index = starts + np.ceil(ok_count * 0.95).astype(np.int64) - 1
+        p95[has_ok] = sorted_lat[index[has_ok]]
+
+        known = np.nonzero(total)[0]
+        columns = zip(known.tolist(), total[known].tolist(), (ok_count[known] / total[known]).tolist(),
+                      ewma[known].tolist(), p95[known].tolist(), jitter[known].tolist())
+        return {p: {'n': n, 'uptime': up, 'ewma': ew, 'p95': p9, 'jitter': ji}
+                for p, n, up, ew, p9, ji in columns}
+
+    def _scores_python(self, columns, now):
+        samples = {}
+        for ts, pid, lat in zip(columns['ts'], columns['pid'], columns['lat']):
+            if ts >= now - self.max_age:
+                samples.setdefault(pid, []).append((ts, lat))
+
+        result = {}
+        for pid, rows in samples.items():
+            rows.sort()
+            ok = [lat for ts, lat in rows if not math.isnan(lat)]
+            values = {'n': len(rows), 'uptime': len(ok) / len(rows),
+                      'ewma': float('nan'), 'p95': float('nan'), 'jitter': float('nan')}
+            if ok:
+                weights = [(1.0 - self.ewma_alpha) ** (len(ok) - 1 - k) for k in range(len(ok))]
+                values['ewma'] = sum(w * x for w, x in zip(weights, ok)) / sum(weights)
+                values['p95'] = sorted(ok)[math.ceil(len(ok) * 0.95) - 1]
+                mean = sum(ok) / len(ok)
+                values['jitter'] = math.sqrt(max(sum(x * x for x in ok) / len(ok) - mean * mean, 0))
+            result[pid] = values
+        return result
+
+    def write_report(self, scores, report_path):
+        """CSV со всеми показателями, отсортированный по score"""
+        with open(report_path, 'w', encoding='utf-8') as f:
+            f.write('score,uptime,ewma_ms,p95_ms,jitter_ms,samples,url\n')
+            for values in sorted(scores.values(), key=lambda v: v['score']):
+                f.write(f"{values['score']:.0f},{values['uptime']:.3f},{values['ewma']:.0f},"
+                        f"{values['p95']:.0f},{values['jitter']:.0f},{values['n']},{values['url']}\n")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in ('-h', '--help'):
+        print("Использование: python history.py [ПАПКА_ИСТОРИИ]")
+        return
+    path = argv[0] if argv else 'history'
+    history = LatencyHistory(path)
+    start = time.time()
+    scores = history.scores()
+    print(f"📚 Прокси в истории: {len(scores)}, расчёт: {(time.time() - start) * 1000:.0f} мс"
+          f" ({'NumPy' if _numpy() is not None else 'без NumPy'})")
+    for values in sorted(scores.values(), key=lambda v: v['score'])[:20]:
+        print(f"  {values['score']:6.0f}  up {values['uptime']:.2f}  ewma {values['ewma']:5.0f}"
+              f"  p95 {values['p95']:5.0f}  jit {values['jitter']:4.0f}  {values['url'][:60]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# ingest.py - Чтение подписок: обычные списки, base64, Clash YAML, sing-box JSON
+#
+# На выходе всегда поток ссылок (vless://, vmess://, trojan://, ss://, hy2://),
+# которые дальше разбирает FastProxyTester.parse_proxy_url. Большие входы
+# декодируются и нормализуются кусками в пуле процессов.
+
+import os
+import re
+import json
+import base64
+import binascii
+from urllib.parse import quote, urlencode
+
+SCHEMES = ('vless://', 'vmess://', 'trojan://', 'ss://', 'hy2://', 'hysteria2://')
+
+_WHITESPACE = b' \t\r\n\v\f'
+_URLSAFE = bytes.maketrans(b'-_', b'+/')
+
+
+def load_proxies(path, workers=0, parallel_threshold=20000):
+    """Прочитать файл любого поддерживаемого формата и вернуть список ссылок"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return parse_subscription(data, workers, parallel_threshold)
+
+
+def parse_subscription(data, workers=0, parallel_threshold=20000):
+    """Определить формат содержимого и нормализовать в ссылки"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    data = data.lstrip(b'\xef\xbb\xbf').strip()
+    if not data:
+        return []
+
+    if data[:1] in (b'{', b'['):
+        try:
+            return _from_singbox(json.loads(data.decode('utf-8', errors='ignore')))
+        except ValueError:
+            pass
+
+    if re.search(rb'^proxies\s*:', data, re.MULTILINE):
+        return _from_clash(data.decode('utf-8', errors='ignore'))
+
+    # Подписка целиком в base64 (возможно, с переносами строк)
+    if b'://' not in data:
+        decoded = _b64decode_parallel(data, workers, parallel_threshold)
+        if decoded is not None and decoded.strip():
+            return parse_subscription(decoded, workers, parallel_threshold)
+
+    lines = data.decode('utf-8', errors='ignore').splitlines()
+    if len(lines) < parallel_threshold:
+        return _normalize_lines(lines)
+
+    import concurrent.futures
+    chunk_size = max(len(lines) // (_worker_count(workers) * 4), 1000)
+    chunks = [lines[i:i + chunk_size] for i in range(0, len(lines), chunk_size)]
+    result = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=_worker_count(workers)) as pool:
+        for part in pool.map(_normalize_lines, chunks):
+            result.extend(part)
+    return result
+
+
+def _worker_count(workers):
+    return workers if workers > 0 else max(os.cpu_count() or 1, 1)
+
+
+def _normalize_lines(lines):
+    """Построчная нормализация: ссылки как есть, base64-строки раскрываются"""
+    result = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.lower().startswith(SCHEMES):
+            if line.lower().startswith('hysteria2://'):
+                line = 'hy2://' + line[len('hysteria2://'):]
+            result.append(line)
+            continue
+        # Вложенная подписка одной строкой
+        decoded = _b64decode(line.encode('ascii', errors='ignore'))
+        if decoded and b'://' in decoded:
+            result.extend(_normalize_lines(decoded.decode('utf-8', errors='ignore').splitlines()))
+    return result
+
+
+def _b64decode(data):
+    """Обычный и url-safe base64, с переносами строк и без выравнивания '='"""
+    data = data.translate(_URLSAFE, _WHITESPACE).rstrip(b'=')
+    if not data:
+        return None
+    data += b'=' * (-len(data) % 4)
+    try:
+        return base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def _b64decode_parallel(data, workers, parallel_threshold):
+    """Большой base64-блок делится на куски, кратные 4 символам, и декодируется в пуле"""
+    data = data.translate(_URLSAFE, _WHITESPACE).rstrip(b'=')
+    # Порог в строках переводим в байты: ~100 байт на ссылку
+    if len(data) < parallel_threshold * 100:
+        return _b64decode(data)
+
+    import concurrent.futures
+    data += b'=' * (-len(data) % 4)
+    count = _worker_count(workers)
+    step = max(len(data) // count // 4 * 4, 4)
+    chunks = [data[i:i + step] for i in range(0, len(data), step)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=count) as pool:
+        parts = list(pool.map(_b64decode, chunks))
+    if any(part is None for part in parts):
+        return None
+    return b''.join(parts)
+
+
+# ---------- Clash / sing-box -> ссылки ----------
+
+def _from_clash(text):
+    try:
+        import yaml
+    except ImportError:
+        print("⚠️  Для Clash YAML нужен PyYAML: pip install pyyaml")
+        return []
+    try:
+        document = yaml.safe_load(text) or {}
+    except yaml.YAMLError as e:
+        print(f"⚠️  Некорректный YAML: {e}")
+        return []
+
+    result = []
+    for proxy in document.get('proxies') or []:
+        if not isinstance(proxy, dict):
+            continue
+        ws = proxy.get('ws-opts') or {}
+        grpc = proxy.get('grpc-opts') or {}
+        reality = proxy.get('reality-opts') or {}
+        record = {
+            'type': proxy.get('type'),
+            'name': proxy.get('name', ''),
+            'server': proxy.get('server'),
+            'port': proxy.get('port'),
+            'uuid': proxy.get('uuid'),
+            'password': proxy.get('password'),
+            'method': proxy.get('cipher'),
+            'alter_id': proxy.get('alterId', 0),
+            'flow': proxy.get('flow'),
+            'network': proxy.get('network', 'tcp'),
+            'path': ws.get('path'),
+            'host': (ws.get('headers') or {}).get('Host'),
+            'service_name': grpc.get('grpc-service-name'),
+            'tls': bool(proxy.get('tls')) or proxy.get('type') in ('trojan', 'hysteria2'),
+            'sni': proxy.get('servername') or proxy.get('sni'),
+            'insecure': bool(proxy.get('skip-cert-verify')),
+            'pbk': reality.get('public-key'),
+            'sid': reality.get('short-id'),
+            'fp': proxy.get('client-fingerprint'),
+        }
+        url = _to_url(record)
+        if url:
+            result.append(url)
+    return result
+
+
+def _from_singbox(document):
+    outbounds = document.get('outbounds', []) if isinstance(document, dict) else document
+    result = []
+    for outbound in outbounds or []:
+        if not isinstance(outbound, dict):
+            continue
+        tls = outbound.get('tls') or {}
+        transport = outbound.get('transport') or {}
+        reality = tls.get('reality') or {}
+        record = {
+            'type': outbound.get('type'),
+            'name': outbound.get('tag', ''),
+            'server': outbound.get('server'),
+            'port': outbound.get('server_port'),
+            'uuid': outbound.get('uuid'),
+            'password': outbound.get('password'),
+            'method': outbound.get('method'),
+            'alter_id': outbound.get('alter_id', 0),
+            'flow': outbound.get('flow'),
+            'network': transport.get('type', 'tcp'),
+            'path': transport.get('path'),
+            'host': (transport.get('headers') or {}).get('Host'),
+            'service_name': transport.get('service_name'),
+            'tls': bool(tls.get('enabled')),
+            'sni': tls.get('server_name'),
+            'insecure': bool(tls.get('insecure')),
+            'pbk': reality.get('public_key') if reality.get('enabled') else None,
+            'sid': reality.get('short_id'),
+            'fp': (tls.get('utls') or {}).get('fingerprint'),
+        }
+        url = _to_url(record)
+        if url:
+            result.append(url)
+    return result
+
+
+def _to_url(r):
+    """Общая запись -> ссылка в формате, который понимает parse_proxy_url"""
+    kind, server, port = r['type'], r['server'], r['port']
+    if not kind or not server or not port:
+        return None
+    name = quote(str(r.get('name') or ''))
+    network = r.get('network') or 'tcp'
+    if network == 'http':
+        network = 'h2'
+
+    if kind == 'vmess':
+        config = {
+            'v': '2', 'ps': r.get('name') or '', 'add': server, 'port': str(port),
+            'id': r.get('uuid'), 'aid': str(r.get('alter_id') or 0),
+            'scy': r.get('method') or 'auto', 'net': network,
+            'path': r.get('path') or '', 'host': r.get('host') or '',
+            'tls': 'tls' if r.get('tls') else '', 'sni': r.get('sni') or '',
+        }
+        encoded = base64.b64encode(json.dumps(config, ensure_ascii=False).encode('utf-8')).decode('ascii')
+        return f"vmess://{encoded}"
+
+    if kind == 'shadowsocks' or kind == 'ss':
+        if not r.get('method') or r.get('password') is None:
+            return None
+        # SIP002: URL-safe base64 без '=' - в userinfo не бывает '/', на котором urlparse режет хост
+        auth = base64.urlsafe_b64encode(f"{r['method']}:{r['password']}".encode('utf-8')).decode('ascii').rstrip('=')
+        return f"ss://{auth}@{server}:{port}#{name}"
+
+    query = {}
+    if network != 'tcp':
+        query['type'] = network
+    if r.get('path'):
+        query['path'] = r['path']
+    if r.get('host'):
+        query['host'] = r['host']
+    if r.get('service_name'):
+        query['serviceName'] = r['service_name']
+    if r.get('sni'):
+        query['sni'] = r['sni']
+    if r.get('insecure'):
+        query['allowInsecure'] = '1'
+
+    if kind == 'vless':
+        if r.get('pbk'):
+            query.update(security='reality', pbk=r['pbk'], sid=r.get('sid') or '')
+        elif r.get('tls'):
+            query['security'] = 'tls'
+        if r.get('fp'):
+            query['fp'] = r['fp']
+        if r.get('flow'):
+            query['flow'] = r['flow']
+        credential = r.get('uuid')
+        scheme = 'vless'
+    elif kind == 'trojan':
+        if not r.get('tls'):
+            query['security'] = 'none'
+        credential = r.get('password')
+        scheme = 'trojan'
+    elif kind in ('hysteria2', 'hy2'):
+        if r.get('insecure'):
+            query['insecure'] = '1'
+        credential = r.get('password')
+        scheme = 'hy2'
+    else:
+        return None
+
+    if not credential:
+        return None
+    if ':' in str(server):
+        server = f"[{server}]"
+    suffix = f"?{urlencode(query)}" if query else ''
+    return f"{scheme}://{quote(str(credential), safe='')}@{server}:{port}{suffix}#{name}"
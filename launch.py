@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# launch.py - Запуск sing-box с конфигом без временных файлов на диске
+#
+# memfd - анонимный файл в памяти (Linux), sing-box читает его по /proc/self/fd/N;
+# stdin - конфиг в стандартный ввод (sing-box run -c stdin);
+# file  - временный файл, удаляется после остановки (Windows и прочие).
+#
+# LogDrainer непрерывно читает вывод sing-box, чтобы каналы не переполнялись.
+
+import os
+import re
+import json
+import time
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict, deque
+
+DELIVERY_MODES = ('auto', 'memfd', 'stdin', 'file')
+
+
+def dump_config(config):
+    """Компактный JSON без отступов - sing-box'у отступы не нужны"""
+    return json.dumps(config, separators=(',', ':'), ensure_ascii=False)
+
+
+class ConfigHandle:
+    """Конфиг, подготовленный для передачи sing-box'у одним из способов"""
+
+    def __init__(self, text, mode='auto'):
+        if mode == 'auto':
+            mode = 'memfd' if hasattr(os, 'memfd_create') else 'file'
+        self.mode = mode
+        self.text = text
+        self.fd = None
+        self.path = 'stdin'
+
+        if mode == 'memfd':
+            self.fd = os.memfd_create('sing-box-config')
+            with open(self.fd, 'wb', closefd=False) as f:
+                f.write(text.encode('utf-8'))
+            self.path = f"/proc/self/fd/{self.fd}"
+        elif mode == 'file':
+            with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False, encoding='utf-8') as f:
+                f.write(text)
+                self.path = f.name
+
+    def spawn(self, singbox_path, startupinfo=None, **popen_args):
+        """Запустить sing-box run с этим конфигом; можно вызывать повторно"""
+        process = subprocess.Popen(
+            [singbox_path, 'run', '-c', self.path],
+            stdin=subprocess.PIPE if self.mode == 'stdin' else None,
+            pass_fds=(self.fd,) if self.fd is not None else (),
+            startupinfo=startupinfo,
+            **popen_args
+        )
+        if self.mode == 'stdin':
+            data = self.text if popen_args.get('text') or popen_args.get('encoding') else self.text.encode('utf-8')
+            try:
+                process.stdin.write(data)
+                process.stdin.close()
+            except OSError:
+                pass
+        return process
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        elif self.mode == 'file' and self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
+def write_debug(debug_dir, name, content):
+    """Отладочный файл - только если задана папка для отладки; возвращает путь или None"""
+    if not debug_dir:
+        return None
+    os.makedirs(debug_dir, exist_ok=True)
+    path = os.path.join(debug_dir, name)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content if isinstance(content, str) else json.dumps(content, indent=2, ensure_ascii=False))
+    return path
+
+
+class LogDrainer:
+    """Фоновое чтение stdout/stderr sing-box. Без него переполненный канал
+    останавливает sing-box на записи в лог. Последние строки хранятся для
+    сообщений об ошибке запуска, ошибки с тегом proxy-N / inbound-N - по номеру прокси"""
+
+    TAG = re.compile(r"\[(?:proxy|inbound)-(\d+)\]")
+    LEVEL = re.compile(r"\b(?:ERROR|FATAL|PANIC)\b")
+    COLOR = re.compile(r"\x1b\[[0-9;]*m")
+
+    def __init__(self, process, tail=200):
+        self._lock = threading.Lock()
+        self._tail = deque(maxlen=tail)
+        self._failures = defaultdict(list)  # номер прокси -> [(время, строка)]
+        self._threads = [threading.Thread(target=self._drain, args=(stream,), daemon=True)
+                         for stream in (process.stdout, process.stderr) if stream is not None]
+        for thread in self._threads:
+            thread.start()
+
+    def _drain(self, stream):
+        try:
+            for line in stream:
+                line = self.COLOR.sub('', line if isinstance(line, str) else line.decode('utf-8', 'replace')).rstrip()
+                if not line:
+                    continue
+                now = time.time()
+                with self._lock:
+                    self._tail.append(line)
+                    if not self.LEVEL.search(line):
+                        continue
+                    for index in {int(number) for number in self.TAG.findall(line)}:
+                        self._failures[index].append((now, line))
+        except (OSError, ValueError):
+            pass
+
+    def failures(self, index, since=0):
+        """Строки лога об ошибках прокси index, записанные не раньше since"""
+        with self._lock:
+            return [line for ts, line in self._failures.get(index, ()) if ts >= since]
+
+    def text(self):
+        """Последние строки вывода"""
+        with self._lock:
+            return '\n'.join(self._tail)
+
+    def join(self, timeout=1):
+        """Дождаться конца вывода (после остановки процесса)"""
+        for thread in self._threads:
+            thread.join(timeout)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# limiter.py - Ограничение одновременных проверок на один upstream ([limits])
+#
+# Ключи - IP/хост сервера, подсеть /24, SNI/Host, UUID/пароль. На каждый ключ
+# не больше per_key проверок сразу и не быстрее rate в секунду (token bucket).
+
+import math
+import time
+import ipaddress
+import threading
+from collections import Counter, defaultdict, deque
+
+KEY_TYPES = ('server', 'subnet', 'sni', 'uuid')
+
+
+def upstream_keys(config, key_types):
+    """Ключи upstream'а из outbound'а sing-box"""
+    if not config:
+        return ()
+    keys = []
+    server = str(config.get('server') or '').strip('[]').lower()
+    for key_type in key_types:
+        if key_type == 'server' and server:
+            keys.append(f"server:{server}")
+        elif key_type == 'subnet':
+            try:
+                address = ipaddress.ip_address(server)
+            except ValueError:
+                continue
+            prefix = 24 if address.version == 4 else 48
+            keys.append(f"subnet:{ipaddress.ip_network(f'{server}/{prefix}', strict=False)}")
+        elif key_type == 'sni':
+            tls = config.get('tls') or {}
+            headers = (config.get('transport') or {}).get('headers') or {}
+            name = tls.get('server_name') or headers.get('Host') or (config.get('transport') or {}).get('host')
+            if name:
+                keys.append(f"sni:{str(name).lower()}")
+        elif key_type == 'uuid':
+            secret = config.get('uuid') or config.get('password')
+            if secret:
+                keys.append(f"uuid:{secret}")
+    return tuple(keys)
+
+
+def interleave(items, key_of):
+    """Раскидать элементы с одинаковым ключом по очереди (round-robin),
+    сохраняя порядок внутри ключа и порядок первых появлений ключей"""
+    groups = defaultdict(deque)
+    order = []
+    for item in items:
+        key = key_of(item)
+        if key not in groups:
+            order.append(key)
+        groups[key].append(item)
+
+    result = []
+    while order:
+        remaining = []
+        for key in order:
+            result.append(groups[key].popleft())
+            if groups[key]:
+                remaining.append(key)
+        order = remaining
+    return result
+
+
+class HostLimiter:
+    """Счётчики активных проверок и token bucket по каждому ключу"""
+
+    def __init__(self, per_key=0, rate=0.0, burst=1):
+        self.per_key = per_key
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._lock = threading.Lock()
+        self._active = Counter()
+        self._buckets = {}   # ключ -> [токены, время обновления]
+
+    @property
+    def enabled(self):
+        return self.per_key > 0 or self.rate > 0
+
+    def try_acquire(self, keys):
+        """0 - слот получен; иначе сколько секунд подождать
+        (math.inf - ждать освобождения слота другой проверкой)"""
+        if not keys or not self.enabled:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            if self.per_key > 0 and any(self._active[key] >= self.per_key for key in keys):
+                return math.inf
+
+            wait = 0.0
+            if self.rate > 0:
+                for key in keys:
+                    bucket = self._buckets.setdefault(key, [float(self.burst), now])
+                    bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                    bucket[1] = now
+                    if bucket[0] < 1:
+                        wait = max(wait, (1 - bucket[0]) / self.rate)
+                if wait > 0:
+                    return wait
+                for key in keys:
+                    self._buckets[key][0] -= 1
+
+            for key in keys:
+                self._active[key] += 1
+            return 0.0
+
+    def release(self, keys):
+        if not keys or not self.enabled:
+            return
+        with self._lock:
+            for key in keys:
+                self._active[key] -= 1
+                if self._active[key] <= 0:
+                    del self._active[key]
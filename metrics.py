@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# metrics.py - Живые метрики тестирования в текстовом формате Prometheus
+
+import time
+import bisect
+import threading
+from collections import deque
+
+
+class Metrics:
+    """Потокобезопасный набор счётчиков, gauge и гистограмм"""
+
+    def __init__(self, prefix='proxy_tester', rate_window=30):
+        self.prefix = prefix
+        self.rate_window = rate_window
+        self._lock = threading.Lock()
+        self._meta = {}         # имя -> (тип, описание)
+        self._values = {}       # имя -> {labels: значение}
+        self._histograms = {}   # имя -> {'buckets', 'counts', 'sum', 'count'}
+        self._completions = deque()
+
+    def define(self, name, kind, help_text, buckets=None):
+        """Объявить метрику: counter, gauge или histogram"""
+        with self._lock:
+            self._meta[name] = (kind, help_text)
+            if kind == 'histogram':
+                buckets = sorted(buckets or (0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+                self._histograms[name] = {
+                    'buckets': buckets,
+                    'counts': [0] * (len(buckets) + 1),
+                    'sum': 0.0,
+                    'count': 0,
+                }
+            else:
+                self._values.setdefault(name, {})
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values.setdefault(name, {})[key] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            hist = self._histograms[name]
+            hist['counts'][bisect.bisect_left(hist['buckets'], value)] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def mark_done(self, count=1):
+        """Отметить протестированные прокси для расчёта скорости"""
+        now = time.monotonic()
+        with self._lock:
+            self._completions.append((now, count))
+            self._trim(now)
+
+    def rate(self):
+        """Прокси в секунду за последние rate_window секунд"""
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            if not self._completions:
+                return 0.0
+            total = sum(count for _, count in self._completions)
+            span = max(now - self._completions[0][0], 1.0)
+        return total / span
+
+    def _trim(self, now):
+        while self._completions and now - self._completions[0][0] > self.rate_window:
+            self._completions.popleft()
+
+    def render(self):
+        """Текст в формате Prometheus exposition 0.0.4"""
+        rate = self.rate()
+        lines = []
+        with self._lock:
+            if 'proxies_per_second' in self._meta:
+                self._values['proxies_per_second'] = {(): rate}
+
+            for name, (kind, help_text) in self._meta.items():
+                full = f"{self.prefix}_{name}"
+                lines.append(f"# HELP {full} {help_text}")
+                lines.append(f"# TYPE {full} {kind}")
+
+                if kind == 'histogram':
+                    hist = self._histograms[name]
+                    cumulative = 0
+                    for bound, count in zip(hist['buckets'], hist['counts']):
+                        cumulative += count
+                        lines.append(f'{full}_bucket{{le="{bound:g}"}} {cumulative}')
+                    lines.append(f'{full}_bucket{{le="+Inf"}} {hist["count"]}')
+                    lines.append(f"{full}_sum {hist['sum']:.6f}")
+                    lines.append(f"{full}_count {hist['count']}")
+                    continue
+
+                series = self._values.get(name) or {(): 0}
+                for labels, value in series.items():
+                    lines.append(f"{full}{_format_labels(labels)} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def start_metrics_server(metrics, port, host='127.0.0.1'):
+    """Поднять HTTP-эндпоинт /metrics в фоновом потоке"""
+    # http.server тянет http.client и email - только когда эндпоинт действительно нужен
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
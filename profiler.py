@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# profiler.py - Профилирование стадий конвейера тестирования (--profile)
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+
+class StageProfiler:
+    """Стеночное и CPU-время по стадиям каждой пачки + трасса Chrome"""
+
+    def __init__(self, enabled=False, cprofile=False, trace_memory=False):
+        self.enabled = enabled
+        self.cprofile = cprofile and enabled
+        self.trace_memory = trace_memory and enabled
+        self._lock = threading.Lock()
+        self._events = []   # события для chrome://tracing
+        self._totals = {}   # стадия -> [кол-во, wall, cpu, память]
+        self._origin = time.perf_counter()
+        self._profile = None
+
+    def start(self):
+        if not self.enabled:
+            return
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        if self.cprofile:
+            # cProfile видит только основной поток (разбор, конфиги, запуск sing-box)
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop(self):
+        if self._profile:
+            self._profile.disable()
+
+    def stage(self, name, **args):
+        """Контекст для замера стадии; без --profile ничего не стоит"""
+        if not self.enabled:
+            return nullcontext()
+        return self._measure(name, args)
+
+    @contextmanager
+    def _measure(self, name, args):
+        mem_before = self._traced_memory()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            mem_delta = self._traced_memory() - mem_before
+
+            event_args = dict(args, cpu_ms=round(cpu * 1000, 3))
+            if self.trace_memory:
+                event_args['mem_delta_kb'] = round(mem_delta / 1024, 1)
+
+            with self._lock:
+                self._events.append({
+                    'name': name,
+                    'cat': 'stage',
+                    'ph': 'X',
+                    'ts': round((wall_start - self._origin) * 1e6),
+                    'dur': round(wall * 1e6),
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                    'args': event_args,
+                })
+                totals = self._totals.setdefault(name, [0, 0.0, 0.0, 0])
+                totals[0] += 1
+                totals[1] += wall
+                totals[2] += cpu
+                totals[3] += mem_delta
+
+    def _traced_memory(self):
+        if not self.trace_memory:
+            return 0
+        import tracemalloc
+        return tracemalloc.get_traced_memory()[0]
+
+    def summary(self):
+        """Таблица: стадия, вызовов, wall, CPU, доля wall"""
+        if not self.enabled or not self._totals:
+            return ''
+
+        total_wall = sum(t[1] for t in self._totals.values()) or 1
+        header = f"{'Стадия':<16}{'Вызовов':>9}{'Wall, с':>11}{'CPU, с':>10}{'Доля':>8}"
+        if self.trace_memory:
+            header += f"{'Память, КБ':>13}"
+        lines = [header, '-' * len(header)]
+
+        for name, (count, wall, cpu, mem) in sorted(self._totals.items(), key=lambda x: -x[1][1]):
+            line = f"{name:<16}{count:>9}{wall:>11.3f}{cpu:>10.3f}{wall / total_wall * 100:>7.1f}%"
+            if self.trace_memory:
+                line += f"{mem / 1024:>13.1f}"
+            lines.append(line)
+
+        if self.trace_memory:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(f"Память Python: текущая {current / 1024:.0f} КБ, пик {peak / 1024:.0f} КБ")
+        return '\n'.join(lines)
+
+    def write(self, out_dir='profile'):
+        """Сохранить трассу (Chrome trace JSON), сводку и данные cProfile/tracemalloc"""
+        if not self.enabled:
+            return []
+        self.stop()
+        os.makedirs(out_dir, exist_ok=True)
+        written = []
+
+        trace_path = os.path.join(out_dir, 'trace.json')
+        with self._lock:
+            events = list(self._events)
+        with open(trace_path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        written.append(trace_path)
+
+        summary_path = os.path.join(out_dir, 'summary.txt')
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            f.write(self.summary() + '\n')
+        written.append(summary_path)
+
+        if self._profile:
+            stats_path = os.path.join(out_dir, 'python.pstats')
+            self._profile.dump_stats(stats_path)
+            written.append(stats_path)
+
+        if self.trace_memory:
+            import tracemalloc
+            top_path = os.path.join(out_dir, 'memory_top.txt')
+            snapshot = tracemalloc.take_snapshot()
+            with open(top_path, 'w', encoding='utf-8') as f:
+                for stat in snapshot.statistics('lineno')[:30]:
+                    f.write(f"{stat}\n")
+            written.append(top_path)
+
+        return written
@@ -13,12 +13,15 @@ from urllib.parse import urlparse, parse_qs
 import requests
  
 from core import Config, ProxyParser, SingBoxManager, ConnectionTester, GeoLocator
+from launch import write_debug
  
 class SimpleProxyTester:
     """Детальный однопоточный тестер прокси"""
     
-    def __init__(self, config_file='option.ini'):
+    def __init__(self, config_file='option.ini', debug_dir=None):
         self.config = Config(config_file)
+        # Конфиги и логи ошибок - только в эту папку и только по запросу (--debug ПАПКА)
+        self.debug_dir = debug_dir
         self.config.validate_singbox()
         
         # Переопределяем тестовый URL для простого тестера
@@ -120,15 +123,10 @@ class SimpleProxyTester:
         # Создаем конфиг
         config = self.create_simple_config(proxy_config, port)
         
-        # Сохраняем конфиг для отладки (опционально)
-        debug_mode = True
-        config_filename = None
-        
-        if debug_mode:
-            config_filename = f"debug_{port}.json"
-            with open(config_filename, 'w', encoding='utf-8') as f:
-                json.dump(config, f, indent=2)
-            print(f"    📄 Конфиг: {config_filename}")
+        # Сохраняем конфиг для отладки (только по запросу)
+        debug_file = write_debug(self.debug_dir, f"debug_{port}.json", config)
+        if debug_file:
+            print(f"    📄 Конфиг: {debug_file}")
         
         # Запускаем sing-box
         startupinfo = None
@@ -157,8 +155,7 @@ class SimpleProxyTester:
             print(f"    ❌ Sing-box упал: {stderr[:100]}")
             
             # Сохраняем логи ошибок
-            with open(f"error_{port}.log", 'w') as f:
-                f.write(stderr)
+            write_debug(self.debug_dir, f"error_{port}.log", stderr)
             
             SingBoxManager.stop_process(process)
             return None
@@ -171,13 +168,6 @@ class SimpleProxyTester:
         # Останавливаем процесс
         SingBoxManager.stop_process(process)
         
-        # Удаляем временные файлы
-        if debug_mode and config_filename and os.path.exists(config_filename):
-            try:
-                os.unlink(config_filename)
-            except:
-                pass
-        
         if success and ip:
             # Получаем детальную информацию о геолокации
             geo_info = GeoLocator.get_geo_info(ip)
@@ -282,19 +272,26 @@ def main():
     print("🔧 ДЕТАЛЬНАЯ ПРОВЕРКА ПРОКСИ")
     print("=" * 60)
     
-    if len(sys.argv) < 2:
-        print("Использование: python simple_tester.py <файл_с_прокси>")
+    args = sys.argv[1:]
+    debug_dir = None
+    if '--debug' in args:
+        position = args.index('--debug')
+        debug_dir = args[position + 1] if position + 1 < len(args) else 'debug'
+        del args[position:position + 2]
+    
+    if not args:
+        print("Использование: python simple_tester.py <файл_с_прокси> [--debug ПАПКА]")
         print("Пример: python simple_tester.py working_proxies.txt")
         print("\nПримечание: Лучше использовать с уже проверенными рабочими прокси")
         sys.exit(1)
     
-    input_file = sys.argv[1]
+    input_file = args[0]
     
     if not os.path.exists(input_file):
         print(f"❌ Файл не найден: {input_file}")
         sys.exit(1)
     
-    tester = SimpleProxyTester()
+    tester = SimpleProxyTester(debug_dir=debug_dir)
     tester.run(input_file)
     
     print("\n🎉 Готово!")
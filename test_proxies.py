@@ -2,24 +2,86 @@
 #!/usr/bin/env python3
  
 import os
+import io
 import sys
+import re
 import json
+import math
 import time
+import random
+import heapq
+import socket
+import hashlib
+import statistics
+import ipaddress
 import subprocess
 import configparser
-import requests
 import threading
 import queue
 from pathlib import Path
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, quote, unquote
 import warnings
-import tempfile
-import concurrent.futures
+import collections
+
+from metrics import Metrics, start_metrics_server
+from profiler import StageProfiler
+from ingest import load_proxies
+from history import LatencyHistory
+from limiter import HostLimiter, upstream_keys, interleave, KEY_TYPES
+from launch import ConfigHandle, LogDrainer, dump_config, DELIVERY_MODES
  
 warnings.filterwarnings('ignore', message='Unverified HTTPS request')
  
+# Группа-selector со всеми outbound'ами пачки для замера через Clash API
+CLASH_GROUP = 'probe-all'
+ 
+# Классы неудачных проверок: пробы возвращают их четвёртым элементом,
+# по ним считаются количество и потраченное время (out/errors.json)
+LOCAL_REFUSED = 'local-refused'         # локальный inbound sing-box не принял соединение
+SOCKS_FAIL = 'socks-fail'               # sing-box ответил ошибкой SOCKS (upstream недоступен)
+DIAL_TIMEOUT = 'upstream-dial-timeout'  # не дождались соединения с upstream
+TLS_FAIL = 'tls-fail'                   # ошибка TLS до тестового URL
+CONN_RESET = 'conn-reset'               # соединение оборвано
+READ_TIMEOUT = 'read-timeout'           # соединение есть, ответа нет
+HTTP_STATUS = 'http-status'             # ответ 4xx/5xx
+SLOW = 'slow'                           # ответ дольше max_delay
+DEADLINE = 'deadline'                   # проверка не уложилась в срок пачки
+DNS_FAIL = 'dns-fail'                   # sing-box не нашёл адрес сервера (по логу)
+HANDSHAKE_FAIL = 'handshake-fail'       # сервер не прошёл рукопожатие TLS/Reality/протокола (по логу)
+OTHER = 'other'
+
+# Относительная стоимость проверки по протоколу и надбавки за транспорт и TLS
+# (для упаковки пачек, когда истории по прокси нет)
+PROTOCOL_COST = {'shadowsocks': 1.0, 'trojan': 1.2, 'vmess': 1.2, 'vless': 1.2, 'hysteria2': 1.5}
+TRANSPORT_COST = 0.2
+TLS_COST = 0.3
+REALITY_COST = 0.5
+ 
+class TopK:
+    """Ограниченная куча: хранит не больше k самых быстрых прокси"""
+    
+    def __init__(self, k):
+        self.k = k
+        self._heap = []  # (-задержка, -порядковый номер, url) - на вершине самый медленный
+        self._seq = 0
+    
+    def push(self, url, delay):
+        item = (-delay, -self._seq, url)
+        self._seq += 1
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+        elif item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+    
+    def ranked(self):
+        """Список (url, задержка) от быстрых к медленным"""
+        return [(url, -neg_delay) for neg_delay, neg_seq, url in sorted(self._heap, reverse=True)]
+    
+    def __len__(self):
+        return len(self._heap)
+ 
 class FastProxyTester:
-    def __init__(self, config_file='option.ini'):
+    def __init__(self, config_file='option.ini', profiler=None):
         self.config = configparser.ConfigParser()
         self.config.read(config_file, encoding='utf-8')
         
@@ -28,6 +90,86 @@ class FastProxyTester:
         self.attempts = self.config.getint('test', 'attempts', fallback=2)
         self.threads = self.config.getint('test', 'threads', fallback=5)
         self.batch_size = self.config.getint('test', 'batch_size', fallback=50)
+        self.global_queue = self.config.getboolean('test', 'global_queue', fallback=False)
+        self.batch_deadline = self.config.getfloat('test', 'batch_deadline', fallback=0)
+        self.log_fail_fast = self.config.getboolean('test', 'log_fail_fast', fallback=True)
+        self.pack_batches = self.config.getboolean('test', 'pack_batches', fallback=False)
+        
+        # Как передавать конфиг sing-box'у: auto, memfd, stdin или file
+        self.config_delivery = self.config.get('paths', 'config_delivery', fallback='auto').strip().lower()
+        if self.config_delivery not in DELIVERY_MODES:
+            print(f"⚠️  Неизвестный config_delivery = {self.config_delivery}, использую auto")
+            self.config_delivery = 'auto'
+        
+        # Шардирование (--shard i/N): None - проверять всё
+        self.shard = None
+        self.shard_dir = 'shards'
+        
+        # Локальные порты пачек; шарды на одной машине делят диапазон между собой
+        self.port_base = 10000
+        self.port_span = 50000
+        
+        # Бэкенд проверки: http - запросы из Python через inbound каждого прокси,
+        # clash - замер задержки самим sing-box через Clash API
+        self.backend = self.config.get('test', 'backend', fallback='http').strip().lower()
+        
+        # Inbound'ы для http-бэкенда: per_proxy - свой порт на каждый прокси,
+        # single - один порт, прокси выбирается по имени пользователя SOCKS (auth_user)
+        self.inbound_mode = self.config.get('test', 'inbound_mode', fallback='per_proxy').strip().lower()
+        
+        # Несколько целей через один туннель и правило прохождения
+        self.targets = [t for t in re.split(r'[\s,]+', self.config.get('test', 'targets', fallback='')) if t]
+        self.targets_required = self._parse_pass_rule(self.config.get('test', 'pass_rule', fallback='any'))
+        self.target_latency = {}  # url прокси -> {цель: задержка или None}
+        
+        # Выходной IP прокси: из ответа тестового URL (эхо-сервис вроде ipify) или отдельного url
+        self.egress = self.config.getboolean('egress', 'enabled', fallback=False) and self.backend != 'clash'
+        self.egress_url = self.config.get('egress', 'url', fallback='').strip() or self.test_url
+        # Куда идти за IP, если в ответе проверки его не нашлось (204 и т.п.)
+        self.egress_echo_url = self.config.get('egress', 'url', fallback='').strip() or 'https://api.ipify.org'
+        self.egress_dedupe = self.config.getboolean('egress', 'dedupe', fallback=False)
+        self.egress_ips = {}  # url прокси -> выходной IP
+        
+        # Несколько замеров после прогрева: медиана и jitter, останов при уверенном вердикте
+        self.samples = self.config.getint('samples', 'count', fallback=0)
+        self.samples_min = max(self.config.getint('samples', 'min_count', fallback=2), 1)
+        self.samples_z = self.config.getfloat('samples', 'z', fallback=2)
+        self.latency_samples = {}  # url прокси -> {'median', 'jitter', 'samples'}
+        
+        # Досрочный вердикт по логу - только когда одна ошибка outbound'а решает всю проверку:
+        # с несколькими целями или замерами часть запросов вправе упасть (pass_rule, [samples]).
+        # У single inbound в логе тег общего inbound'а - строку не отнести к прокси
+        if self.backend != 'clash' and (self.targets or self.samples > 1 or self.inbound_mode == 'single'):
+            self.log_fail_fast = False
+        
+        # Хеджирование попыток вместо последовательных повторов
+        self.hedge = self.config.getboolean('test', 'hedge', fallback=False)
+        self.hedge_percentile = self.config.getfloat('test', 'hedge_percentile', fallback=90)
+        self._recent_latency = collections.deque(maxlen=500)
+        self._latency_lock = threading.Lock()
+        self._hedge_executor = None
+        self._hedge_untracked = False  # предупреждение о старом urllib3 уже выведено
+        if self.hedge:
+            import concurrent.futures
+            self._hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.threads * max(len(self.targets), 1) * self.attempts)
+        
+        # Повторы по классу ошибки: классы без повтора, попыток на класс,
+        # пауза с экспоненциальным ростом и разбросом, общий бюджет на прокси
+        self.retry_never = {c for c in re.split(r'[\s,]+', self.config.get(
+            'retry', 'no_retry', fallback='local-refused, http-status, dns-fail, handshake-fail').lower()) if c}
+        self.retry_attempts = self._parse_retry_attempts(self.config.get('retry', 'attempts', fallback=''))
+        self.retry_backoff = self.config.getfloat('retry', 'backoff', fallback=0.5)
+        self.retry_factor = self.config.getfloat('retry', 'factor', fallback=2)
+        self.retry_jitter = self.config.getfloat('retry', 'jitter', fallback=0.2)
+        self.retry_budget = self.config.getfloat('retry', 'budget', fallback=0)
+        self.retry_stats = {}  # класс -> [повторов, стали рабочими]
+        self._retry_lock = threading.Lock()
+        self._target_executor = None
+        if self.targets:
+            import concurrent.futures
+            self._target_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.threads * len(self.targets))
         
         self.is_windows = os.name == 'nt'
                 
@@ -52,11 +194,139 @@ class FastProxyTester:
         self.bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
         self.chat_id = os.environ.get('TELEGRAM_CHAT_ID')
         
+        # Отправка отчёта и архив результатов
+        self.tg_api_url = self.config.get('telegram', 'api_url', fallback='https://api.telegram.org').rstrip('/')
+        self.tg_timeout = self.config.getfloat('telegram', 'timeout', fallback=30)
+        self.tg_retries = self.config.getint('telegram', 'retries', fallback=3)
+        self.tg_backoff = self.config.getfloat('telegram', 'backoff', fallback=2)
+        self.tg_delta = self.config.getboolean('telegram', 'delta', fallback=True)
+        self.zip_level = self.config.getint('telegram', 'compress_level', fallback=6)
+        self.zip_path = 'out/results.zip'
+        self.tg_state_path = 'out/.telegram_state.json'
+        
+        self._archive_lock = threading.Lock()
+        self._archived = {}  # имя файла -> sha256, добавленные в архив за этот запуск
+        self._upload_queue = queue.Queue()
+        self._upload_thread = None
+        
+        # Живые метрики в формате Prometheus (port = 0 - выключено)
+        self.metrics_port = self.config.getint('metrics', 'port', fallback=0)
+        self.metrics_listen = self.config.get('metrics', 'listen', fallback='127.0.0.1')
+        self.metrics = self._create_metrics()
+        self._metrics_server = None
+        
+        # Отсев: сначала представители групп с общим backend'ом, остальные - если те живы
+        self.prune = self.config.getboolean('prune', 'enabled', fallback=False)
+        self.prune_min_group = self.config.getint('prune', 'min_group', fallback=4)
+        self.prune_sample = self.config.getint('prune', 'sample', fallback=2)
+        self.prune_dead_sample = self.config.getfloat('prune', 'dead_sample', fallback=0)
+        
+        # Лимит одновременных проверок на один upstream (сервер, /24, SNI/Host, UUID)
+        self.limit_keys = [k for k in re.split(r'[\s,]+', self.config.get('limits', 'keys', fallback='').lower())
+                           if k in KEY_TYPES]
+        self.limiter = HostLimiter(
+            per_key=self.config.getint('limits', 'per_key', fallback=4) if self.limit_keys else 0,
+            rate=self.config.getfloat('limits', 'rate', fallback=0) if self.limit_keys else 0,
+            burst=self.config.getint('limits', 'burst', fallback=2))
+        
+        # Чтение подписок: процессов для больших входов (0 - по числу ядер)
+        # и с какого числа строк включать пул процессов
+        self.ingest_workers = self.config.getint('ingest', 'workers', fallback=0)
+        self.ingest_threshold = self.config.getint('ingest', 'parallel_threshold', fallback=20000)
+        
+        # Ранжирование по задержке: top_k = 0 - выключено, group_by = none/protocol/country
+        self.top_k = self.config.getint('output', 'top_k', fallback=0)
+        self.group_by = self.config.get('output', 'group_by', fallback='none').strip().lower()
+        self._country_cache = {}
+        
+        # Готовый клиентский конфиг sing-box из лучших прокси (out/singbox_<файл>.json)
+        self.export_singbox = self.config.getboolean('export', 'singbox', fallback=False)
+        self.export_count = self.config.getint('export', 'count', fallback=20)
+        self.export_port = self.config.getint('export', 'listen_port', fallback=2080)
+        self.export_interval = self.config.get('export', 'interval', fallback='3m').strip()
+        self.export_tolerance = self.config.getint('export', 'tolerance', fallback=50)
+        
+        # История задержек между запусками: ранжирование top-K и порядок проверки
+        self.history = None
+        if self.config.getboolean('history', 'enabled', fallback=False):
+            self.history = LatencyHistory(
+                self.config.get('history', 'dir', fallback='history'),
+                ewma_alpha=self.config.getfloat('history', 'ewma_alpha', fallback=0.3),
+                max_age_days=self.config.getfloat('history', 'max_age_days', fallback=14),
+                max_delay=self.max_delay)
+        self.history_rank = self.config.getboolean('history', 'rank', fallback=True)
+        self.history_schedule = self.config.getboolean('history', 'schedule', fallback=True)
+        self.history_scores = {}
+        self._history_keys = {}
+        
+        # Профилирование стадий (--profile)
+        self.profiler = profiler or StageProfiler()
+        self.profile_dir = 'profile'
+        
         self.stats = {}
+        self.error_stats = {}  # (файл, протокол, класс) -> [проверок, секунд]
         self.failed_batches = []  # новое
 
     
     
+    def _parse_pass_rule(self, rule):
+        """any / all / k / k/n -> сколько целей должно пройти"""
+        rule = rule.strip().lower()
+        total = max(len(self.targets), 1)
+        if rule == 'all':
+            return total
+        if rule in ('', 'any'):
+            return 1
+        try:
+            return min(max(int(rule.split('/')[0]), 1), total)
+        except ValueError:
+            print(f"⚠️  Неизвестное правило pass_rule = {rule}, используется any")
+            return 1
+    
+    def _parse_retry_attempts(self, text):
+        """"read-timeout:3, slow:1" -> {класс: попыток}"""
+        attempts = {}
+        for item in re.split(r'[\s,]+', text.strip().lower()):
+            if not item:
+                continue
+            name, _, count = item.partition(':')
+            try:
+                attempts[name] = max(int(count), 1)
+            except ValueError:
+                print(f"⚠️  Неверная запись в [retry] attempts: {item}")
+        return attempts
+    
+    def _create_metrics(self):
+        metrics = Metrics()
+        metrics.define('proxies_tested_total', 'counter', 'Протестировано прокси')
+        metrics.define('proxies_working_total', 'counter', 'Рабочих прокси')
+        metrics.define('proxies_failed_total', 'counter', 'Нерабочих прокси по классу ошибки')
+        metrics.define('probes_in_flight', 'gauge', 'Проверки, выполняющиеся сейчас')
+        metrics.define('singbox_processes', 'gauge', 'Запущенные процессы sing-box')
+        metrics.define('batches_total', 'counter', 'Обработанные пачки по статусу')
+        metrics.define('files_processed_total', 'counter', 'Обработанные входные файлы')
+        metrics.define('file_pending_proxies', 'gauge', 'Осталось прокси в текущем файле')
+        metrics.define('batch_startup_seconds', 'histogram', 'Время запуска sing-box для пачки',
+                       buckets=(0.5, 1, 2, 3, 4, 5, 7.5, 10, 15))
+        metrics.define('probe_latency_seconds', 'histogram', 'Длительность проверки одного прокси',
+                       buckets=(0.1, 0.25, 0.5, 1, 1.5, 2, 3, 5, 10))
+        metrics.define('proxies_per_second', 'gauge', 'Текущая скорость тестирования')
+        metrics.define('proxies_pruned_total', 'counter', 'Пропущено прокси из групп с нерабочим backend\'ом')
+        metrics.define('probe_retries_total', 'counter', 'Повторные попытки по классу ошибки')
+        metrics.define('probe_retries_rescued_total', 'counter', 'Прокси, заработавшие после повтора, по классу ошибки')
+        metrics.define('latency_samples_total', 'counter', 'Замеры задержки после прогрева')
+        return metrics
+    
+    def start_metrics(self):
+        """Запустить HTTP-эндпоинт метрик, если он включен в option.ini"""
+        if not self.metrics_port or self._metrics_server:
+            return
+        try:
+            self._metrics_server = start_metrics_server(self.metrics, self.metrics_port, self.metrics_listen)
+            print(f"📈 Метрики: http://{self.metrics_listen}:{self.metrics_port}/metrics")
+        except OSError as e:
+            print(f"⚠️  Не удалось запустить метрики: {e}")
+    
     def parse_proxy_url(self, url):
         url = url.strip()
         if not url or url.startswith('#'):
@@ -152,13 +422,16 @@ class FastProxyTester:
     def _parse_vmess(self, url, parsed):
         import base64
         
-        if len(parsed.username) > 50:
+        # Стандартная ссылка vmess://<base64 JSON> не содержит '@'
+        encoded = parsed.username or url.split('://', 1)[1]
+        
+        if len(encoded) > 50:
             try:
-                padding = 4 - len(parsed.username) % 4
+                padding = 4 - len(encoded) % 4
                 if padding != 4:
-                    username = parsed.username + '=' * padding
+                    username = encoded + '=' * padding
                 else:
-                    username = parsed.username
+                    username = encoded
                     
                 decoded = base64.b64decode(username).decode('utf-8')
                 vmess_config = json.loads(decoded)
@@ -259,12 +532,12 @@ class FastProxyTester:
         import base64
         
         try:
-            padding = 4 - len(parsed.username) % 4
+            auth_part = unquote(parsed.username)
+            padding = 4 - len(auth_part) % 4
             if padding != 4:
-                auth_part = parsed.username + '=' * padding
-            else:
-                auth_part = parsed.username
-            decoded = base64.b64decode(auth_part).decode('utf-8')
+                auth_part += '=' * padding
+            # urlsafe_b64decode понимает и '-_' (SIP002), и обычные '+/'
+            decoded = base64.urlsafe_b64decode(auth_part).decode('utf-8')
             method, password = decoded.split(':', 1)
         except:
             if ':' in parsed.username:
@@ -309,8 +582,7 @@ class FastProxyTester:
         """Создать конфиг для тестирования пачки прокси"""
         config = {
             "log": {
-                "level": "error",
-                "output": "/dev/null" if not self.is_windows else "nul"
+                "level": "error"
             },
             "inbounds": [],
             "outbounds": [
@@ -323,6 +595,15 @@ class FastProxyTester:
             }
         }
         
+        # Лог нужен в stderr, где его читает LogDrainer (log_fail_fast); иначе - в никуда
+        if not self.log_fail_fast:
+            config["log"]["output"] = "/dev/null" if not self.is_windows else "nul"
+        
+        if self.backend == 'clash':
+            return self._add_clash_api(config, proxy_configs, base_port)
+        if self.inbound_mode == 'single':
+            return self._add_single_inbound(config, proxy_configs, base_port)
+        
         # Добавляем inbound для каждого прокси
         for i, proxy_config in enumerate(proxy_configs):
             if proxy_config is None:
@@ -355,19 +636,211 @@ class FastProxyTester:
         
         return config
     
-    def test_batch_proxies(self, proxy_urls, batch_num, total_batches,  global_start_idx=0):
-        """Тестировать пачку прокси в одном sing-box процессе"""
+    def _add_single_inbound(self, config, proxy_configs, port):
+        """Один mixed inbound с пользователем на каждый прокси и правилами auth_user"""
+        inbound = {
+            "type": "mixed",
+            "tag": "inbound",
+            "listen": "127.0.0.1",
+            "listen_port": port,
+            "sniff": False,
+            "users": []
+        }
+        config["inbounds"].append(inbound)
+        
+        for i, proxy_config in enumerate(proxy_configs):
+            if proxy_config is None:
+                continue
+            
+            proxy_tag = f"proxy-{i}"
+            inbound["users"].append({"username": f"u{i}", "password": "p"})
+            
+            proxy_config["tag"] = proxy_tag
+            config["outbounds"].append(proxy_config)
+            
+            config["route"]["rules"].append({
+                "auth_user": [f"u{i}"],
+                "outbound": proxy_tag
+            })
+        
+        # Неизвестный пользователь не должен уходить в direct
+        config["outbounds"].append({"type": "block", "tag": "block"})
+        config["route"]["final"] = "block"
+        return config
+    
+    def create_client_config(self, ranked):
+        """Клиентский конфиг: urltest по лучшим прокси (от быстрых к медленным) + selector"""
+        outbounds = []
+        tags = []
+        # Служебные теги конфига заняты с самого начала
+        used = {"proxy", "auto", "direct"}
+        for url, delay in ranked:
+            proxy_config = self.parse_proxy_url(url)
+            if not proxy_config:
+                continue
+            name = unquote(url.split('#', 1)[1]).strip() if '#' in url else ''
+            base = name or f"proxy-{len(tags) + 1}"
+            tag, n = base, 1
+            while tag in used:
+                n += 1
+                tag = f"{base} #{n}"
+            used.add(tag)
+            proxy_config["tag"] = tag
+            outbounds.append(proxy_config)
+            tags.append(tag)
+        
+        return {
+            "log": {"level": "warn"},
+            "inbounds": [{
+                "type": "mixed",
+                "tag": "mixed-in",
+                "listen": "127.0.0.1",
+                "listen_port": self.export_port
+            }],
+            "outbounds": [
+                {"type": "selector", "tag": "proxy", "outbounds": ["auto"] + tags, "default": "auto"},
+                {"type": "urltest", "tag": "auto", "outbounds": tags, "url": self.test_url,
+                 "interval": self.export_interval, "tolerance": self.export_tolerance},
+            ] + outbounds + [
+                {"type": "direct", "tag": "direct"}
+            ],
+            "route": {
+                "rules": [
+                    {"protocol": "dns", "outbound": "direct"}
+                ],
+                "final": "proxy"
+            }
+        }
+    
+    def _write_client_config(self, config_path, working):
+        """Записать клиентский конфиг из export_count лучших по задержке (или score истории)"""
+        ranked = sorted(working, key=lambda item: self._rank_delay(*item))[:self.export_count]
+        config = self.create_client_config(ranked)
+        tmp_path = config_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(config, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, config_path)
+        return len(ranked)
+    
+    def _batch_base_port(self, batch_num):
+        """Первый порт пачки: по порту на прокси или один порт на пачку.
+        Порты идут по кругу внутри диапазона [port_base, port_base + port_span)"""
+        if self.backend == 'clash' or self.inbound_mode == 'single':
+            return self.port_base + (batch_num - 1) % self.port_span
+        slots = max(self.port_span // self.batch_size, 1)
+        return self.port_base + ((batch_num - 1) % slots) * self.batch_size
+    
+    def _probe_endpoint(self, base_port, i):
+        """SOCKS-адрес, через который проверяется i-й прокси пачки"""
+        if self.inbound_mode == 'single':
+            return f'socks5://u{i}:p@127.0.0.1:{base_port}'
+        return f'socks5://127.0.0.1:{base_port + i}'
+    
+    def _add_clash_api(self, config, proxy_configs, api_port):
+        """Конфиг без inbound'ов: только outbound'ы, группа для замера и Clash API"""
+        tags = []
+        for i, proxy_config in enumerate(proxy_configs):
+            if proxy_config is None:
+                continue
+            proxy_config["tag"] = f"proxy-{i}"
+            config["outbounds"].append(proxy_config)
+            tags.append(proxy_config["tag"])
+        
+        config["outbounds"].append({"type": "selector", "tag": CLASH_GROUP, "outbounds": tags})
+        config["route"]["final"] = "direct"
+        config["experimental"] = {
+            "clash_api": {"external_controller": f"127.0.0.1:{api_port}"}
+        }
+        return config
+    
+    def _clash_group_delay(self, api_port):
+        """Один запрос: sing-box параллельно меряет задержку всех outbound'ов группы"""
+        import requests
+        try:
+            response = requests.get(
+                f"http://127.0.0.1:{api_port}/group/{CLASH_GROUP}/delay",
+                params={'url': self.test_url, 'timeout': self.max_delay},
+                timeout=self.max_delay / 1000 + 5
+            )
+            if response.status_code == 200:
+                return response.json()
+            print(f"  ⚠️  Clash API: HTTP {response.status_code}")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"  ⚠️  Clash API: {type(e).__name__}")
+        return {}
+    
+    def _clash_probe(self, api_port, tag, group_delay=None):
+        """Результат из группового замера, при неудаче - замер через /proxies/{tag}/delay.
+        Прокси без группового результата меряется отдельно хотя бы раз (групповой замер
+        идёт с общим таймаутом и ограниченной параллельностью), дальше - политика [retry]"""
+        import requests
+        if group_delay and group_delay <= self.max_delay:
+            return True, group_delay, f"✅ {group_delay:.0f}ms", None
+        
+        # Медленный групповой результат - уже попытка
+        if group_delay:
+            attempt, last_error, last_class = 1, f"❌ {group_delay:.0f}ms > {self.max_delay}ms", SLOW
+        else:
+            attempt, last_error, last_class = 0, "❌ Не удалось", OTHER
+        start = time.time()
+        
+        while True:
+            if attempt:
+                if attempt >= self._max_attempts(last_class):
+                    break
+                pause = self._retry_pause(attempt)
+                if self.retry_budget > 0 and time.time() - start + pause >= self.retry_budget:
+                    break
+                self._count_retry(last_class)
+                time.sleep(pause)
+            attempt += 1
+            try:
+                response = requests.get(
+                    f"http://127.0.0.1:{api_port}/proxies/{quote(tag)}/delay",
+                    params={'url': self.test_url, 'timeout': self.max_delay},
+                    timeout=self.max_delay / 1000 + 2
+                )
+                data = response.json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                last_error, last_class = f"⚠️  {type(e).__name__}", OTHER
+                continue
+            
+            delay = data.get('delay')
+            if response.status_code == 200 and delay:
+                if delay <= self.max_delay:
+                    if attempt > 1:
+                        self._count_retry(last_class, rescued=True)
+                    return True, delay, f"✅ {delay:.0f}ms", None
+                last_error, last_class = f"❌ {delay:.0f}ms > {self.max_delay}ms", SLOW
+                continue
+            
+            reason = str(data.get('message', '')).lower()
+            if 'refused' in reason:
+                last_error, last_class = "🔌 Нет соединения", SOCKS_FAIL
+            elif 'timeout' in reason or 'deadline' in reason or response.status_code == 504:
+                last_error, last_class = "⌛ Таймаут", DIAL_TIMEOUT
+            elif 'tls' in reason or 'certificate' in reason:
+                last_error, last_class = "🔐 Ошибка TLS", TLS_FAIL
+            else:
+                last_error, last_class = "🔄 Ошибка прокси", SOCKS_FAIL
+        
+        return False, 0, last_error, last_class
+    
+    def test_batch_proxies(self, proxy_urls, batch_num, total_batches,  global_start_idx=0, sources=None):
+        """Тестировать пачку прокси в одном sing-box процессе.
+        sources - имя входного файла для каждой ссылки (для учёта ошибок по файлам)"""
         print(f"\n🔧 Пакет {batch_num}/{total_batches} ({len(proxy_urls)} прокси)")
         
         # Парсим все прокси в пачке
         proxy_configs = []
         valid_indices = []
         
-        for i, url in enumerate(proxy_urls):
-            config = self.parse_proxy_url(url)
-            proxy_configs.append(config)
-            if config:
-                valid_indices.append(i)
+        with self.profiler.stage('parse', batch=batch_num):
+            for i, url in enumerate(proxy_urls):
+                config = self.parse_proxy_url(url)
+                proxy_configs.append(config)
+                if config:
+                    valid_indices.append(i)
         
         if not valid_indices:
             print("  ⚠️  Нет валидных прокси в пачке")
@@ -375,17 +848,21 @@ class FastProxyTester:
         
         # Создаем конфиг для всей пачки
         #base_port = 20000 + (batch_num - 1) * 1000
-        base_port = 10000 + (batch_num - 1) * self.batch_size
+        base_port = self._batch_base_port(batch_num)
+        
+        with self.profiler.stage('build_config', batch=batch_num):
+            batch_config = self.create_batch_config(proxy_configs, base_port)
         
-        batch_config = self.create_batch_config(proxy_configs, base_port)
+        with self.profiler.stage('serialize', batch=batch_num):
+            config_text = dump_config(batch_config)
         
-        # Сохраняем конфиг
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False, encoding='utf-8') as f:
-            json.dump(batch_config, f, indent=2)
-            config_file = f.name
+        # Конфиг для sing-box: в памяти (memfd), через stdin или во временном файле
+        with self.profiler.stage('write_config', batch=batch_num):
+            config_handle = ConfigHandle(config_text, self.config_delivery)
         
         process = None
         results = []
+        singbox_counted = False
         
 
             
@@ -400,23 +877,38 @@ class FastProxyTester:
             
             MAX_RETRIES = 3
             process = None
+            startup_begin = time.time()
             
             for retry in range(MAX_RETRIES):
-                print(f"  🚀 Запускаю sing-box (порты {base_port}-{base_port + len(proxy_urls) - 1})...")
+                if self.backend == 'clash':
+                    print(f"  🚀 Запускаю sing-box (Clash API на порту {base_port})...")
+                elif self.inbound_mode == 'single':
+                    print(f"  🚀 Запускаю sing-box (один inbound на порту {base_port})...")
+                else:
+                    print(f"  🚀 Запускаю sing-box (порты {base_port}-{base_port + len(proxy_urls) - 1})...")
                 
-                process = subprocess.Popen(
-                    [self.singbox_path, 'run', '-c', config_file],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    startupinfo=startupinfo,
-                    text=True,
-                    encoding='utf-8'
-                )
+                with self.profiler.stage('spawn', batch=batch_num, retry=retry):
+                    process = config_handle.spawn(
+                        self.singbox_path,
+                        startupinfo,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        text=True,
+                        encoding='utf-8',
+                        errors='replace'
+                    )
+                    # Вывод читается всё время работы: полный канал остановил бы sing-box
+                    drainer = LogDrainer(process)
                 
-                time.sleep(0.5)
+                with self.profiler.stage('ready_wait', batch=batch_num, retry=retry):
+                    time.sleep(0.5)
+                    started = process.poll() is None
+                    if started:
+                        time.sleep(2.5)
                 
-                if process.poll() is not None:
-                    stderr = process.stderr.read()
+                if not started:
+                    drainer.join()
+                    stderr = drainer.text()
                     if "address already in use" in stderr and retry < MAX_RETRIES - 1:
                         print(f"  ⚠️ Порт занят, повтор {retry+2}/{MAX_RETRIES}...")
                         time.sleep(2)
@@ -425,56 +917,144 @@ class FastProxyTester:
                         print(f"  ❌ Не запустился: {stderr[:200]}")
                         break
                 else:
-                    time.sleep(2.5)
                     break
             
             if process is None or process.poll() is not None:
                 self.failed_batches.append(batch_num) 
+                self.metrics.inc('batches_total', status='failed')
                 return []
             
+            self.metrics.observe('batch_startup_seconds', time.time() - startup_begin)
+            self.metrics.inc('singbox_processes', 1)
+            singbox_counted = True
             print(f"  ✅ Sing-box запущен, тестирую...")            
             
             
             
-            # Тестируем каждый валидный прокси
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
-                future_to_index = {}
-                
-                for i in valid_indices:
-                    port = base_port + i
-                    proxy_url = proxy_urls[i]
-                    future = executor.submit(self._test_proxy_connection, port, proxy_url)
-                    future_to_index[future] = (i, proxy_url)
-                
-                # Собираем результаты
-                for future in concurrent.futures.as_completed(future_to_index):
-                    i, proxy_url = future_to_index[future]
-                    try:
-                        success, delay, message = future.result(timeout=self.max_delay/1000 + 2)
-                        results.append((i, proxy_url, success, delay, message))
+            # Тестируем каждый валидный прокси: одинаковые upstream'ы вперемешку с другими,
+            # с лимитом одновременных проверок на ключ (limits)
+            keys = {i: upstream_keys(proxy_configs[i], self.limit_keys) for i in valid_indices}
+            pending = collections.deque(interleave(valid_indices, lambda i: keys[i][:1]))
+            
+            import concurrent.futures
+            # Брошенным по логу пробам нужны свои потоки, пока их не закроет остановка sing-box
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.threads * 2 if self.log_fail_fast else self.threads)
+            expired = False
+            abandoned = 0
+            try:
+                with self.profiler.stage('probe', batch=batch_num, proxies=len(valid_indices)):
+                    running = {}  # future -> (индекс, время запуска)
+                    group_delays = self._clash_group_delay(base_port) if self.backend == 'clash' else {}
+                    batch_deadline = self._batch_deadline(len(valid_indices))
+                    deadline = time.time() + batch_deadline
+                    
+                    while pending or running:
+                        if time.time() >= deadline:
+                            expired = True
+                            break
+                        
+                        # Запускаем всё, что позволяют потоки и лимиты
+                        wait_hint = math.inf
+                        for _ in range(len(pending)):
+                            if len(running) >= self.threads:
+                                break
+                            i = pending.popleft()
+                            wait = self.limiter.try_acquire(keys[i])
+                            if wait:
+                                pending.append(i)
+                                wait_hint = min(wait_hint, wait)
+                                continue
+                            proxy_url = proxy_urls[i]
+                            if self.backend == 'clash':
+                                future = executor.submit(self._measured_probe, self._clash_probe,
+                                                         base_port, f"proxy-{i}", group_delays.get(f"proxy-{i}"))
+                            else:
+                                future = executor.submit(self._measured_probe, self._test_proxy_connection,
+                                                         self._probe_endpoint(base_port, i), proxy_url)
+                            running[future] = (i, time.time())
                         
-                        # Выводим результат
-                        # proxy_id = proxy_url.split('@')[1].split(':')[0] if '@' in proxy_url else "unknown"
-                        # print(f"  [{i+1:3d}] {proxy_id}: {message}")
+                        timeout = max(min(wait_hint, deadline - time.time()), 0)
+                        if self.log_fail_fast:
+                            # Почаще заглядываем в лог sing-box
+                            timeout = min(timeout, 0.2)
+                        if not running:
+                            time.sleep(min(timeout, 1.0))
+                            continue
                         
-                        global_idx = global_start_idx + i + 1
-                        proxy_id = proxy_url.split('@')[1].split(':')[0] if '@' in proxy_url else "unknown"
-                        print(f"  [{global_idx:4d}] {proxy_id}: {message}")
-                                                
-                    except concurrent.futures.TimeoutError:
-                        proxy_id = proxy_url.split('@')[1].split(':')[0] if '@' in proxy_url else "unknown"
-                        print(f"  [{i+1:3d}] {proxy_id}: ⏱️ Таймаут теста")
-                        results.append((i, proxy_url, False, 0, "⏱️ Таймаут теста"))
-                    except Exception as e:
-                        proxy_id = proxy_url.split('@')[1].split(':')[0] if '@' in proxy_url else "unknown"
-                        print(f"  [{i+1:3d}] {proxy_id}: ❌ Ошибка: {e}")
-                        results.append((i, proxy_url, False, 0, f"❌ Ошибка: {e}"))
+                        done, _ = concurrent.futures.wait(
+                            running, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                        
+                        # Собираем результаты
+                        for future in done:
+                            i, started = running.pop(future)
+                            self.limiter.release(keys[i])
+                            proxy_url = proxy_urls[i]
+                            try:
+                                success, delay, message, error, seconds = future.result()
+                                results.append((i, proxy_url, success, delay, message, error, seconds))
+                                
+                                # Выводим результат
+                                # proxy_id = proxy_url.split('@')[1].split(':')[0] if '@' in proxy_url else "unknown"
+                                # print(f"  [{i+1:3d}] {proxy_id}: {message}")
+                                
+                                global_idx = global_start_idx + i + 1
+                                proxy_id = proxy_url.split('@')[1].split(':')[0] if '@' in proxy_url else "unknown"
+                                print(f"  [{global_idx:4d}] {proxy_id}: {message}")
+                                
+                            except Exception as e:
+                                proxy_id = proxy_url.split('@')[1].split(':')[0] if '@' in proxy_url else "unknown"
+                                print(f"  [{i+1:3d}] {proxy_id}: ❌ Ошибка: {e}")
+                                results.append((i, proxy_url, False, 0, f"❌ Ошибка: {e}", OTHER, 0))
+                            
+                            self._count_result(results[-1], sources[i] if sources else '-')
+                        
+                        # sing-box уже сообщил, что outbound не работает: не ждём таймаута HTTP
+                        if self.log_fail_fast:
+                            for future, (i, started) in list(running.items()):
+                                failure = self._log_failure(drainer.failures(i, started))
+                                if failure is None:
+                                    continue
+                                del running[future]
+                                abandoned += 1
+                                self.limiter.release(keys[i])
+                                message, error = failure
+                                proxy_url = proxy_urls[i]
+                                proxy_id = proxy_url.split('@')[1].split(':')[0] if '@' in proxy_url else "unknown"
+                                print(f"  [{global_start_idx + i + 1:4d}] {proxy_id}: {message}")
+                                results.append((i, proxy_url, False, 0, message, error, time.time() - started))
+                                self._count_result(results[-1], sources[i] if sources else '-')
+                    
+                    if expired:
+                        # Срок пачки вышел: sing-box убиваем сразу - у зависших проб
+                        # закрываются сокеты, и их потоки завершаются сами
+                        process.kill()
+                        stragglers = list(running.values()) + [(i, None) for i in pending]
+                        print(f"  ⏰ Срок пачки {batch_deadline:.0f} сек истёк, не дождались: {len(stragglers)}")
+                        now = time.time()
+                        for i, started in sorted(stragglers):
+                            if started is not None:
+                                self.limiter.release(keys[i])
+                            proxy_url = proxy_urls[i]
+                            proxy_id = proxy_url.split('@')[1].split(':')[0] if '@' in proxy_url else "unknown"
+                            print(f"  [{global_start_idx + i + 1:4d}] {proxy_id}: ⏱️ Таймаут теста")
+                            results.append((i, proxy_url, False, 0, "⏱️ Таймаут теста", DEADLINE,
+                                            now - started if started is not None else 0))
+                            self._count_result(results[-1], sources[i] if sources else '-')
+            finally:
+                # После дедлайна не ждём потоки: не начатые пробы отменяются, начатые уже без sing-box.
+                # Брошенные по логу пробы тоже не ждём - завершатся с остановкой sing-box
+                executor.shutdown(wait=not expired and not abandoned, cancel_futures=True)
+            
+            self.metrics.inc('batches_total', status='deadline' if expired else 'ok')
             
             # Сортируем по индексу
             results.sort(key=lambda x: x[0])
             
+            self._record_history(results)
+            
             # Собираем рабочие прокси
-            working = [url for i, url, success, delay, msg in results if success]
+            working = [(i, url, delay) for i, url, success, delay, *_ in results if success]
             
             print(f"  📊 Работает: {len(working)}/{len(valid_indices)}")
             return working
@@ -483,86 +1063,587 @@ class FastProxyTester:
             print(f"  ❌ Ошибка пачки: {e}")
             return []
         finally:
-            # Останавливаем sing-box
-            if process and process.poll() is None:
-                process.terminate()
-                try:
-                    process.wait(timeout=2)
-                except:
-                    process.kill()
-            
-            # Удаляем временный файл
+            with self.profiler.stage('teardown', batch=batch_num):
+                # Останавливаем sing-box
+                if process and process.poll() is None:
+                    process.terminate()
+                    try:
+                        process.wait(timeout=2)
+                    except:
+                        process.kill()
+                if singbox_counted:
+                    self.metrics.inc('singbox_processes', -1)
+                
+                # Закрываем memfd или удаляем временный файл
+                config_handle.close()
+    
+    def _batch_deadline(self, count):
+        """Жёсткий срок на пробы пачки, сек: из настроек или худший случай
+        волн проверок (попытки с паузами по max_delay) плюс запас"""
+        if self.batch_deadline > 0:
+            return self.batch_deadline
+        waves = math.ceil(count / max(self.threads, 1))
+        return waves * self._probe_worst_case() + 2
+    
+    def _probe_worst_case(self):
+        """Худшее время одной проверки, сек: все попытки по max_delay, паузы между ними
+        и дополнительные замеры задержки"""
+        attempts = max([self.attempts] + list(self.retry_attempts.values()))
+        pauses = sum(self.retry_backoff * self.retry_factor ** k for k in range(attempts - 1))
+        seconds = self.max_delay / 1000 * attempts + pauses * (1 + self.retry_jitter)
+        if self.retry_budget > 0:
+            seconds = min(seconds, self.retry_budget + self.max_delay / 1000)
+        if self.samples > 1:
+            seconds += self.samples * self.max_delay / 1000
+        return seconds
+    
+    def _count_result(self, result, source='-'):
+        """Учесть результат проверки в счётчиках метрик и во времени по классам ошибок"""
+        i, proxy_url, success, delay, message, error, seconds = result
+        self.metrics.inc('proxies_tested_total')
+        if success:
+            self.metrics.inc('proxies_working_total')
+        else:
+            self.metrics.inc('proxies_failed_total', reason=error)
+        
+        protocol = proxy_url.split('://', 1)[0].lower()
+        entry = self.error_stats.setdefault((source, protocol, error or 'ok'), [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+    
+    def _measured_probe(self, probe, *args):
+        """Проверка прокси с учётом в живых метриках; к результату добавляется длительность"""
+        self.metrics.inc('probes_in_flight', 1)
+        start_time = time.time()
+        try:
+            result = probe(*args)
+        finally:
+            seconds = time.time() - start_time
+            self.metrics.inc('probes_in_flight', -1)
+            self.metrics.observe('probe_latency_seconds', seconds)
+            self.metrics.mark_done()
+        return result + (seconds,)
+    
+    def _test_proxy_connection(self, endpoint, proxy_url):
+        """Тест подключения через локальный SOCKS endpoint пачки"""
+        capture = {} if self.egress else None
+        if self.targets:
+            result = self._test_proxy_targets(endpoint, proxy_url, capture)
+        else:
+            result = self._probe_url(endpoint, self.test_url, capture=capture)
+            # Первый ответ - прогрев; медленный тоже: его могли раздуть DNS и первое соединение
+            if self.samples > 1 and (result[0] or result[3] == SLOW):
+                result = self._sample_latency(endpoint, proxy_url)
+        if self.egress and result[0]:
+            self._remember_egress(endpoint, proxy_url, capture)
+        return result
+    
+    def _remember_egress(self, endpoint, proxy_url, capture):
+        """Выходной IP рабочего прокси: из ответа проверки или отдельным запросом к egress url"""
+        import requests
+        ip = capture.get('ip')
+        if ip is None:
             try:
-                os.unlink(config_file)
-            except:
+                response = requests.get(
+                    self.egress_echo_url,
+                    proxies={'http': endpoint, 'https': endpoint},
+                    timeout=self.max_delay/1000,
+                    verify=False,
+                    headers={'User-Agent': 'Mozilla/5.0'}
+                )
+                ip = self._parse_egress_ip(response.text)
+            except Exception:
                 pass
+        if ip:
+            self.egress_ips[proxy_url] = ip
+    
+    @staticmethod
+    def _parse_egress_ip(text):
+        """IP из ответа эхо-сервиса: голый IP (ipify), JSON с ip/origin (httpbin) или первый IPv4 в тексте"""
+        text = (text or '').strip()
+        candidates = [text]
+        try:
+            data = json.loads(text)
+            if isinstance(data, dict):
+                candidates = [str(data.get('ip') or data.get('origin') or '').split(',')[0].strip()]
+        except ValueError:
+            match = re.search(r"\b\d{1,3}(?:\.\d{1,3}){3}\b", text)
+            if match:
+                candidates.append(match.group(0))
+        for candidate in candidates:
+            try:
+                return str(ipaddress.ip_address(candidate))
+            except ValueError:
+                continue
+        return None
+    
+    def _test_proxy_targets(self, endpoint, proxy_url, capture=None):
+        """Параллельная проверка нескольких целей через один inbound"""
+        import requests
+        import concurrent.futures
+        session = requests.Session()
+        try:
+            futures = {
+                self._target_executor.submit(self._probe_url, endpoint, target, session,
+                                             capture if target == self.egress_url else None): target
+                for target in self.targets
+            }
+            per_target = {}
+            for future in concurrent.futures.as_completed(futures):
+                per_target[futures[future]] = future.result()
+        finally:
+            session.close()
+        
+        self.target_latency[proxy_url] = {
+            target: round(delay) if ok else None for target, (ok, delay, msg, error) in per_target.items()
+        }
+        
+        passed = [delay for ok, delay, msg, error in per_target.values() if ok]
+        # Оценка: средняя задержка по всем целям, неудачная цель считается как max_delay
+        score = (sum(passed) + self.max_delay * (len(self.targets) - len(passed))) / len(self.targets)
+        summary = f"{len(passed)}/{len(self.targets)} целей"
+        
+        if len(passed) >= self.targets_required:
+            return True, score, f"✅ {score:.0f}ms ({summary})", None
+        
+        failed = [(msg, error) for ok, delay, msg, error in per_target.values() if not ok]
+        return False, 0, f"{failed[0][0]} ({summary})", failed[0][1]
+    
+    def _sample_latency(self, endpoint, proxy_url):
+        """До samples замеров через тот же inbound после прогрева. Если без ответа
+        осталось больше половины - неудача с классом последней ошибки. Иначе медиана
+        ответивших; останов, когда она отстоит от max_delay больше чем на z стандартных
+        ошибок - дополнительные замеры достаются пограничным прокси"""
+        samples = []
+        failed = 0
+        last_message, last_error = "", None
+        while len(samples) + failed < self.samples:
+            success, elapsed, message, error = self._probe_once(endpoint, self.test_url)
+            if not success and error != SLOW:
+                failed += 1
+                last_message, last_error = message, error
+                if failed * 2 > self.samples:
+                    break
+                continue
+            samples.append(elapsed)
+            if len(samples) >= max(self.samples_min, 2):
+                median = statistics.median(samples)
+                margin = self.samples_z * statistics.stdev(samples) / math.sqrt(len(samples))
+                if abs(median - self.max_delay) > margin:
+                    break
+        taken = len(samples) + failed
+        self.metrics.inc('latency_samples_total', taken)
+        
+        if failed * 2 > taken:
+            self.latency_samples[proxy_url] = {'median': None, 'jitter': None, 'samples': taken, 'failed': failed}
+            return False, 0, f"{last_message} (без ответа {failed}/{taken})", last_error or OTHER
+        
+        median = statistics.median(samples)
+        jitter = statistics.pstdev(samples)
+        self.latency_samples[proxy_url] = {'median': round(median), 'jitter': round(jitter),
+                                           'samples': taken, 'failed': failed}
+        summary = f"медиана {len(samples)}, ±{jitter:.0f}"
+        if median <= self.max_delay:
+            return True, median, f"✅ {median:.0f}ms ({summary})", None
+        return False, median, f"❌ {median:.0f}ms > {self.max_delay}ms ({summary})", SLOW
     
-    def _test_proxy_connection(self, port, proxy_url):
-        """Тест подключения через указанный порт"""
+    def _probe_url(self, endpoint, url, session=None, capture=None):
+        """Запрос к url через endpoint с повторами; session переиспользует соединения.
+        capture - словарь для выходного IP из ответа, если url - egress url"""
+        if capture is not None and url != self.egress_url:
+            capture = None
+        if self.hedge:
+            # У каждой хеджированной попытки своя сессия: общую закроют раньше, чем брошенные попытки доработают
+            return self._hedged_probe(endpoint, url, capture)
+        
+        start = time.time()
         best_delay = float('inf')
-        last_error = ""
+        last_error, last_class = "", None
+        
+        attempt = 0
+        while True:
+            success, elapsed, message, error = self._probe_once(endpoint, url, session, capture)
+            if success:
+                if attempt:
+                    self._count_retry(last_class, rescued=True)
+                return True, elapsed, message, None
+            if elapsed:
+                best_delay = min(best_delay, elapsed)
+            last_error, last_class = message, error
+            
+            # Повтор - только если класс ошибки его допускает и бюджет прокси не исчерпан
+            attempt += 1
+            if attempt >= self._max_attempts(error):
+                break
+            pause = self._retry_pause(attempt)
+            if self.retry_budget > 0 and time.time() - start + pause >= self.retry_budget:
+                break
+            self._count_retry(error)
+            time.sleep(pause)
+        
+        return self._final_failure(best_delay, last_error, last_class)
+    
+    def _max_attempts(self, error):
+        """Сколько всего попыток положено после ошибки этого класса"""
+        if error in self.retry_never:
+            return 1
+        return self.retry_attempts.get(error, self.attempts)
+    
+    def _retry_pause(self, attempt):
+        """Пауза перед попыткой attempt + 1: backoff * factor^(attempt-1) с разбросом ±jitter"""
+        pause = self.retry_backoff * self.retry_factor ** (attempt - 1)
+        return pause * random.uniform(1 - self.retry_jitter, 1 + self.retry_jitter)
+    
+    def _count_retry(self, error, rescued=False):
+        """Учёт повторов по классам: сколько их было и сколько прокси они спасли"""
+        error = error or OTHER
+        with self._retry_lock:
+            entry = self.retry_stats.setdefault(error, [0, 0])
+            entry[1 if rescued else 0] += 1
+        self.metrics.inc('probe_retries_rescued_total' if rescued else 'probe_retries_total', reason=error)
+    
+    def _final_failure(self, best_delay, last_error, last_class):
+        if best_delay != float('inf'):
+            return False, best_delay, f"❌ {best_delay:.0f}ms > {self.max_delay}ms", SLOW
+        else:
+            return False, 0, last_error or "❌ Не удалось", last_class or OTHER
+    
+    def _probe_once(self, endpoint, url, session=None, capture=None):
+        """Одна попытка. Задержка ненулевая, только если ответ пришёл (в т.ч. медленный)"""
+        import requests
+        get = session.get if session else requests.get
         
-        for attempt in range(self.attempts):
-            try:
-                start_time = time.time()
+        try:
+            start_time = time.time()
+            
+            response = get(
+                url,
+                proxies={'http': endpoint, 'https': endpoint},
+                timeout=self.max_delay/1000,
+                verify=False,
+                headers={'User-Agent': 'Mozilla/5.0'}
+            )
+            elapsed = (time.time() - start_time) * 1000
+            
+            if response.status_code < 400:
+                if elapsed <= self.max_delay:
+                    self._record_latency(elapsed)
+                    if capture is not None:
+                        # Если ответ - от эхо-сервиса, второй запрос за IP не нужен
+                        capture['ip'] = self._parse_egress_ip(response.text)
+                    return True, elapsed, f"✅ {elapsed:.0f}ms", None
+                else:
+                    return False, elapsed, f"⚠️  {elapsed:.0f}ms > {self.max_delay}ms", SLOW
+            else:
+                return False, 0, f"⚠️  HTTP {response.status_code}", HTTP_STATUS
                 
-                # ОТЛАДКА: какая схема используется
-                proxy_dict = {
-                    'http': f'socks5://127.0.0.1:{port}',
-                    'https': f'socks5://127.0.0.1:{port}'
-                }
+        except requests.exceptions.SSLError:
+            return False, 0, "🔐 Ошибка TLS", TLS_FAIL
+        except requests.exceptions.ConnectTimeout:
+            return False, 0, "⌛ Таймаут", DIAL_TIMEOUT
+        except requests.exceptions.ProxyError:
+            return False, 0, "🔄 Ошибка прокси", SOCKS_FAIL
+        except requests.exceptions.ConnectionError as e:
+            return self._connection_failure(e)
+        except requests.exceptions.ReadTimeout:
+            return False, 0, "⏱️ ReadTimeout", READ_TIMEOUT
+        except Exception as e:
+            return False, 0, f"⚠️  {type(e).__name__}", OTHER
+    
+    @staticmethod
+    def _connection_failure(error):
+        """ConnectionError через SOCKS: PySocks кладёт причину в текст исключения"""
+        text = str(error).lower()
+        # Код ответа SOCKS5 (0x01-0x08): sing-box не смог соединиться с upstream
+        if re.search(r"0x0[1-8]", text) or "connection closed unexpectedly" in text:
+            return False, 0, "🔄 Ошибка прокси", SOCKS_FAIL
+        if "refused" in text or "10061" in text:
+            return False, 0, "🔌 Нет соединения", LOCAL_REFUSED
+        if "timed out" in text:
+            return False, 0, "⌛ Таймаут", DIAL_TIMEOUT
+        if "aborted" in text or "reset" in text or "disconnected" in text:
+            return False, 0, "🔌 Соединение сброшено", CONN_RESET
+        return False, 0, f"🔌 Ошибка: {type(error).__name__}", OTHER
+    
+    def _log_failure(self, lines):
+        """Причина неудачи из лога sing-box, если проверка уже обречена:
+        класс без повторов или ошибок в логе не меньше, чем положено попыток"""
+        if not lines:
+            return None
+        message, error = self._classify_log_line(lines[-1])
+        if len(lines) < self._max_attempts(error):
+            return None
+        return f"{message} (лог sing-box)", error
+    
+    @staticmethod
+    def _classify_log_line(line):
+        """Класс ошибки по строке лога sing-box об outbound'е"""
+        text = line.lower()
+        if "no such host" in text or "lookup " in text:
+            return "🌐 Сервер не найден (DNS)", DNS_FAIL
+        if "refused" in text:
+            return "🔄 Сервер отклонил соединение", SOCKS_FAIL
+        if "handshake" in text or "tls" in text or "reality" in text or "certificate" in text:
+            return "🤝 Ошибка рукопожатия", HANDSHAKE_FAIL
+        if "timeout" in text or "timed out" in text:
+            return "⌛ Таймаут", DIAL_TIMEOUT
+        if "reset" in text or "eof" in text or "broken pipe" in text:
+            return "🔌 Соединение сброшено", CONN_RESET
+        return "🔄 Ошибка прокси", SOCKS_FAIL
+    
+    def _record_latency(self, elapsed):
+        if self.hedge:
+            with self._latency_lock:
+                self._recent_latency.append(elapsed)
+    
+    def _hedge_threshold(self):
+        """Через сколько мс запускать следующую попытку (перцентиль недавних задержек)"""
+        with self._latency_lock:
+            samples = sorted(self._recent_latency)
+        if len(samples) < 20:
+            threshold = self.max_delay * 0.5
+        else:
+            threshold = samples[min(int(len(samples) * self.hedge_percentile / 100), len(samples) - 1)]
+        return min(max(threshold, 100), self.max_delay)
+    
+    def _hedged_probe(self, endpoint, url, capture=None):
+        """Хеджированные попытки: следующая стартует, когда текущая дольше перцентиля
+        или уже упала; побеждает первая успешная, остальные обрываются"""
+        import concurrent.futures
+        start = time.time()
+        deadline = start + self.max_delay / 1000
+        threshold = self._hedge_threshold() / 1000
+        
+        sessions = {}  # попытка -> её сессия
+        launched = 0
+        next_launch = start
+        best_delay = float('inf')
+        last_error, last_class = "", None
+        
+        try:
+            while True:
+                now = time.time()
+                if launched < self.attempts and (now >= next_launch or not sessions):
+                    session = self._attempt_session()
+                    sessions[self._hedge_executor.submit(self._probe_once, endpoint, url, session, capture)] = session
+                    launched += 1
+                    next_launch = now + threshold
                 
-                #print(f"  🐛 DEBUG proxy_dict: {proxy_dict}")                
-                    
-                    
-             
-             
+                if not sessions:
+                    break
                 
-                response = requests.get(
-                    self.test_url,
-                    proxies={
-                        'http': f'socks5://127.0.0.1:{port}',
-                        'https': f'socks5://127.0.0.1:{port}'
-                    },
-                    timeout=self.max_delay/1000,
-                    verify=False,
-                    headers={'User-Agent': 'Mozilla/5.0'}
+                wait_until = deadline if launched >= self.attempts else min(next_launch, deadline)
+                done, _ = concurrent.futures.wait(
+                    sessions,
+                    timeout=max(wait_until - time.time(), 0),
+                    return_when=concurrent.futures.FIRST_COMPLETED
                 )
-                elapsed = (time.time() - start_time) * 1000
                 
-                if response.status_code < 400:
-                    if elapsed < best_delay:
-                        best_delay = elapsed
-                    if elapsed <= self.max_delay:
-                        return True, elapsed, f"✅ {elapsed:.0f}ms"
-                    else:
-                        last_error = f"⚠️  {elapsed:.0f}ms > {self.max_delay}ms"
-                else:
-                    last_error = f"⚠️  HTTP {response.status_code}"
-                    
-            except requests.exceptions.ConnectTimeout:
-                last_error = "⌛ Таймаут"
-            except requests.exceptions.ConnectionError as e:
-                if "10061" in str(e) or "refused" in str(e).lower():
-                    last_error = "🔌 Нет соединения"
-                elif "timed out" in str(e).lower():
-                    last_error = "⌛ Таймаут"
-                else:
-                    last_error = f"🔌 Ошибка: {type(e).__name__}"
-            except requests.exceptions.ReadTimeout:
-                last_error = "⏱️ ReadTimeout"
-            except requests.exceptions.ProxyError:
-                last_error = "🔄 Ошибка прокси"
-            except Exception as e:
-                last_error = f"⚠️  {type(e).__name__}"
+                for future in done:
+                    sessions.pop(future).close()
+                    success, elapsed, message, error = future.result()
+                    if success:
+                        return True, elapsed, message, None
+                    if elapsed:
+                        best_delay = min(best_delay, elapsed)
+                    last_error, last_class = message, error
+                    if self._max_attempts(error) <= 1:
+                        # Безнадёжный класс ошибки: новые попытки не запускаем
+                        launched = self.attempts
+                
+                if time.time() >= deadline:
+                    if sessions and not last_error:
+                        last_error, last_class = "⌛ Таймаут", DIAL_TIMEOUT
+                    break
+        finally:
+            # Брошенные попытки: поток освобождается сразу, а не по таймауту запроса
+            for future, session in sessions.items():
+                future.cancel()
+                self._abort_session(session)
+        
+        return self._final_failure(best_delay, last_error, last_class)
+    
+    def _attempt_session(self):
+        """Сессия для одной попытки. Соединения её пулов запоминаются в session.live_connections,
+        чтобы попытку можно было оборвать из другого потока. Только публичные точки расширения:
+        HTTPAdapter.init_poolmanager/proxy_manager_for, pool_classes_by_scheme и ConnectionCls"""
+        import requests
+        session = requests.Session()
+        live = session.live_connections = set()
+        
+        def tracked(manager):
+            classes = getattr(manager, 'pool_classes_by_scheme', None)
+            if classes is None:
+                if not self._hedge_untracked:
+                    self._hedge_untracked = True
+                    print("⚠️  urllib3 без pool_classes_by_scheme: брошенные хедж-попытки доживут до таймаута")
+                return manager
+            if getattr(manager, 'live_connections', None) is not live:
+                manager.pool_classes_by_scheme = {
+                    scheme: type(pool_class.__name__, (pool_class,),
+                                 {'ConnectionCls': tracked_connection(pool_class.ConnectionCls)})
+                    for scheme, pool_class in classes.items()
+                }
+                manager.live_connections = live
+            return manager
+        
+        def tracked_connection(base):
+            class Connection(base):
+                def __init__(self, *args, **kwargs):
+                    super().__init__(*args, **kwargs)
+                    live.add(self)
+            return Connection
+        
+        class Adapter(requests.adapters.HTTPAdapter):
+            def init_poolmanager(self, *args, **kwargs):
+                super().init_poolmanager(*args, **kwargs)
+                tracked(self.poolmanager)
             
-            if attempt < self.attempts - 1:
-                time.sleep(0.5)
+            def proxy_manager_for(self, proxy, **kwargs):
+                return tracked(super().proxy_manager_for(proxy, **kwargs))
         
-        if best_delay != float('inf'):
-            return False, best_delay, f"❌ {best_delay:.0f}ms > {self.max_delay}ms"
-        else:
-            return False, 0, last_error or "❌ Не удалось"
+        session.mount('http://', Adapter())
+        session.mount('https://', Adapter())
+        return session
+    
+    @staticmethod
+    def _abort_session(session):
+        """Оборвать попытку: shutdown будит поток, ждущий ответа на сокете.
+        Рукопожатие SOCKS ещё без сокета у соединения - оно доживёт до своего таймаута"""
+        for conn in list(session.live_connections):
+            sock = getattr(conn, 'sock', None)
+            try:
+                if sock:
+                    sock.shutdown(socket.SHUT_RDWR)
+                conn.close()
+            except OSError:
+                pass
+        session.close()
+    
+    def _read_lines(self, input_file):
+        """Прочитать входной файл через ingest; None - ошибка чтения"""
+        filename = os.path.basename(input_file)
+        try:
+            with self.profiler.stage('read_file', file=filename):
+                return load_proxies(input_file, self.ingest_workers, self.ingest_threshold)
+        except Exception as e:
+            print(f"❌ Ошибка чтения {filename}: {e}")
+            return None
+    
+    def _push_top(self, top_groups, working):
+        """Добавить рабочие (url, задержка) в ограниченные кучи по группам"""
+        if self.top_k <= 0 or not working:
+            return
+        for group, (url, delay) in zip(self._group_keys([url for url, _ in working]), working):
+            top_groups.setdefault(group, TopK(self.top_k)).push(url, self._rank_delay(url, delay))
+    
+    # ---------- История задержек ----------
+    
+    def _history_key(self, url):
+        key = self._history_keys.get(url)
+        if key is None:
+            key = self._history_keys[url] = self._canonical_id(url)
+        return key
+    
+    def _load_history_scores(self):
+        if not self.history:
+            return
+        start_time = time.time()
+        self.history_scores = self.history.scores()
+        print(f"📚 История: {len(self.history_scores)} прокси, расчёт {time.time() - start_time:.2f} сек")
+    
+    def _record_history(self, results):
+        """Дописать в историю все проверенные прокси пачки, включая нерабочие"""
+        if not self.history:
+            return
+        self.history.record([(self._history_key(url), url, delay if success else None)
+                             for i, url, success, delay, *_ in results])
+    
+    def _rank_delay(self, url, delay):
+        """Ключ ранжирования top-K: задержка или score из истории"""
+        if not self.history or not self.history_rank:
+            return delay
+        return self.history.rank(self.history_scores.get(self._history_key(url)), delay)
+    
+    def _schedule(self, urls):
+        """Порядок проверки: сначала стабильно быстрые по истории, затем новые,
+        в конце давно не работавшие; при лимитах upstream'ы перемешиваются.
+        Возвращает индексы в исходном списке"""
+        order = list(range(len(urls)))
+        if self.history and self.history_schedule and self.history_scores:
+            unknown = {'score': self.max_delay}
+            order.sort(key=lambda i: self.history_scores.get(self._history_key(urls[i]), unknown)['score'])
+        if self.limiter.enabled:
+            # Один upstream - по разным пачкам, чтобы лимиту было чем заполнить пачку
+            order = interleave(order, lambda i: upstream_keys(self.parse_proxy_url(urls[i]), self.limit_keys)[:1])
+        return order
+    
+    def _finish_history(self):
+        """Пересчитать показатели после запуска и сохранить отчёт"""
+        if not self.history:
+            return
+        scores = self.history.scores()
+        report_path = os.path.join(self.history.path, 'scores.csv')
+        self.history.write_report(scores, report_path)
+        print(f"📚 История: {len(scores)} прокси, отчёт {report_path}")
+    
+    # ---------- Упаковка пачек по стоимости ----------
+    
+    def _batches(self, urls, phase):
+        """Разбить индексы phase на пачки: подряд по batch_size или, если включено
+        pack_batches, с выравниванием ожидаемого времени пачек"""
+        if not self.pack_batches or len(phase) <= self.batch_size:
+            return [phase[start:start + self.batch_size] for start in range(0, len(phase), self.batch_size)]
+        
+        failure_cost = self._failure_cost()
+        costs = {idx: self._probe_cost(urls[idx], failure_cost) for idx in phase}
+        count = (len(phase) + self.batch_size - 1) // self.batch_size
+        
+        # LPT: самые дорогие - первыми, каждая в самую лёгкую пачку, где есть место
+        batches = [[] for _ in range(count)]
+        heap = [(0.0, n) for n in range(count)]
+        for idx in sorted(phase, key=lambda idx: -costs[idx]):
+            total, n = heapq.heappop(heap)
+            batches[n].append(idx)
+            if len(batches[n]) < self.batch_size:
+                heapq.heappush(heap, (total + costs[idx], n))
+        
+        # Внутри пачки порядок уже от дорогих к дешёвым - длинные проверки стартуют первыми.
+        # Время пачки: вся работа на все потоки, но не меньше самой долгой проверки
+        spans = [max(sum(costs[idx] for idx in batch) / max(self.threads, 1), costs[batch[0]]) for batch in batches]
+        print(f"⚖️  Пачки по стоимости: {count}, оценка {min(spans):.1f}-{max(spans):.1f} сек")
+        return batches
+    
+    def _probe_cost(self, url, failure_cost):
+        """Ожидаемое время проверки, сек: по истории (успех - EWMA, неудача - среднее
+        время неудачной проверки в этом запуске) или по протоколу, транспорту и TLS"""
+        timeout = self.max_delay / 1000
+        values = self.history_scores.get(self._history_key(url)) if self.history_scores else None
+        if values and values['n']:
+            ok_cost = 0.0 if math.isnan(values['ewma']) else values['ewma'] / 1000
+            return values['uptime'] * ok_cost + (1 - values['uptime']) * failure_cost
+        
+        config = self.parse_proxy_url(url)
+        if not config:
+            return 0.0
+        cost = PROTOCOL_COST.get(config.get('type'), 1.0)
+        if config.get('transport'):
+            cost += TRANSPORT_COST
+        tls = config.get('tls') or {}
+        if (tls.get('reality') or {}).get('enabled'):
+            cost += REALITY_COST
+        elif tls.get('enabled'):
+            cost += TLS_COST
+        return cost * timeout * 0.3
+    
+    def _failure_cost(self):
+        """Среднее время неудачной проверки по error_stats; пока замеров нет - полтаймаута"""
+        failed = [(count, seconds) for (source, protocol, error), (count, seconds) in self.error_stats.items()
+                  if error != 'ok']
+        count = sum(count for count, seconds in failed)
+        if not count:
+            return self.max_delay / 1000 / 2
+        return sum(seconds for count, seconds in failed) / count
     
     def process_file(self, input_file):
         """Обработка файла с прокси"""
@@ -571,11 +1652,8 @@ class FastProxyTester:
         print(f"📄 Файл: {filename}")
         print(f"{'='*60}")
         
-        try:
-            with open(input_file, 'r', encoding='utf-8', errors='ignore') as f:
-                lines = [line.strip() for line in f if line.strip() and not line.startswith('#')]
-        except Exception as e:
-            print(f"❌ Ошибка чтения: {e}")
+        lines = self._read_lines(input_file)
+        if lines is None:
             return []
         
         if not lines:
@@ -586,19 +1664,33 @@ class FastProxyTester:
         print(f"⚡ Размер пачки: {self.batch_size}")
         print(f"🧵 Потоков: {self.threads}")
         
-        # Разбиваем на пачки
+        # Разбиваем на пачки (в порядке из истории, если она включена)
+        order = self._schedule(lines)
         all_working = []
-        total_batches = (len(lines) + self.batch_size - 1) // self.batch_size
+        working_urls = set()
+        top_groups = {}
         
         file_start_time = time.time()
         
-        for batch_num in range(total_batches):
-            start_idx = batch_num * self.batch_size
-            end_idx = min(start_idx + self.batch_size, len(lines))
-            batch = lines[start_idx:end_idx]
-            
-            working = self.test_batch_proxies(batch, batch_num + 1, total_batches, start_idx)
-            all_working.extend(working)
+        for phase in self._prune_phases(lines, order, working_urls):
+            batches = self._batches(lines, phase)
+            start_idx = 0
+            for batch_num, batch_indices in enumerate(batches):
+                batch = [lines[idx] for idx in batch_indices]
+                
+                self.metrics.set('file_pending_proxies', len(phase) - start_idx)
+                working = [(batch_indices[i], url, delay) for i, url, delay in
+                           self.test_batch_proxies(batch, batch_num + 1, len(batches), start_idx,
+                                                   [filename] * len(batch))]
+                start_idx += len(batch)
+                all_working.extend(working)
+                working_urls.update(url for idx, url, delay in working)
+                self._push_top(top_groups, [(url, delay) for idx, url, delay in working])
+        
+        # В out/ - в порядке строк исходного файла
+        all_working = [(url, delay) for idx, url, delay in sorted(all_working)]
+        self.metrics.set('file_pending_proxies', 0)
+        self.metrics.inc('files_processed_total')
         
         file_elapsed = time.time() - file_start_time
 
@@ -608,7 +1700,309 @@ class FastProxyTester:
             print(f"⏱️  Чистое время тестирования: {testing_time:.1f} сек")
             print(f"⚡ Реальная скорость: {len(lines)/testing_time:.1f} прокси/сек")
         
-        self.stats[filename] = {'total': len(lines), 'working': len(all_working)}
+        self._save_file_results(filename, len(lines), all_working, top_groups)
+        self.target_latency.clear()
+        self.egress_ips.clear()
+        self.latency_samples.clear()
+        return all_working
+    
+    # ---------- Отсев групп с общим backend'ом ----------
+    
+    def _backend_key(self, url):
+        """Общий backend: протокол, UUID/пароль, SNI/Host и путь без учёта IP фронта.
+        None - прокси ни с кем не группируется"""
+        config = self.parse_proxy_url(url)
+        if not config:
+            return None
+        secret = config.get('uuid') or config.get('password')
+        if not secret:
+            return None
+        tls = config.get('tls') or {}
+        transport = config.get('transport') or {}
+        name = tls.get('server_name') or (transport.get('headers') or {}).get('Host') or config.get('server')
+        return (config.get('type'), secret, str(name).lower(),
+                transport.get('path', ''), transport.get('service_name', ''))
+    
+    @staticmethod
+    def _spread(members, count):
+        """count элементов, равномерно разнесённых по списку"""
+        if count <= 0:
+            return []
+        if count >= len(members):
+            return list(members)
+        step = len(members) / count
+        return [members[int(k * step)] for k in range(count)]
+    
+    def _prune_phases(self, urls, order, working_urls):
+        """Фазы проверки (списки индексов). Сначала - одиночки и по prune_sample
+        представителей от групп с общим backend'ом; затем остальные члены групп,
+        где представитель заработал. working_urls вызывающий пополняет между фазами"""
+        if not self.prune:
+            yield order
+            return
+        
+        position = {idx: n for n, idx in enumerate(order)}
+        groups = {}
+        first = []
+        for idx in order:
+            key = self._backend_key(urls[idx])
+            if key is None:
+                first.append(idx)
+            else:
+                groups.setdefault(key, []).append(idx)
+        
+        expand = []
+        for members in groups.values():
+            if len(members) < self.prune_min_group:
+                first.extend(members)
+                continue
+            representatives = self._spread(members, self.prune_sample)
+            first.extend(representatives)
+            chosen = set(representatives)
+            expand.append((representatives, [idx for idx in members if idx not in chosen]))
+        
+        print(f"✂️  Групп с общим backend'ом: {len(expand)}, сначала проверяю {len(first)} из {len(order)}")
+        yield sorted(first, key=position.get)
+        
+        second = []
+        skipped = dead_groups = 0
+        for representatives, others in expand:
+            if any(urls[idx] in working_urls for idx in representatives):
+                second.extend(others)
+                continue
+            dead_groups += 1
+            sample = self._spread(others, round(len(others) * self.prune_dead_sample))
+            skipped += len(others) - len(sample)
+            second.extend(sample)
+        
+        print(f"\n✂️  Нерабочих групп: {dead_groups}/{len(expand)}, пропущено прокси: {skipped},"
+              f" дальше проверяю: {len(second)}")
+        self.metrics.inc('proxies_pruned_total', skipped)
+        if second:
+            yield sorted(second, key=position.get)
+    
+    def _collect_records(self, input_files):
+        """Строки всех файлов как (имя файла, номер строки, ссылка) + число строк по файлам.
+        В режиме --shard остаются только строки своего шарда"""
+        records = []
+        totals = {}
+        
+        for input_file in input_files:
+            lines = self._read_lines(input_file)
+            if not lines:
+                continue
+            filename = os.path.basename(input_file)
+            totals[filename] = len(lines)
+            records.extend((filename, idx, url) for idx, url in enumerate(lines)
+                           if self.shard is None or self._in_shard(url))
+        
+        order = self._schedule([url for _, _, url in records])
+        return [records[i] for i in order], totals
+    
+    def _test_records(self, records):
+        """Полные пачки из общей очереди; результат - {файл: [(номер строки, url, задержка)]}"""
+        working_by_file = {}
+        working_urls = set()
+        urls = [url for _, _, url in records]
+        
+        start_time = time.time()
+        
+        for phase in self._prune_phases(urls, list(range(len(records))), working_urls):
+            batches = self._batches(urls, phase)
+            start_idx = 0
+            for batch_num, batch_indices in enumerate(batches):
+                batch = [records[i] for i in batch_indices]
+                
+                self.metrics.set('file_pending_proxies', len(phase) - start_idx)
+                working = self.test_batch_proxies([url for _, _, url in batch], batch_num + 1, len(batches),
+                                                  start_idx, [filename for filename, _, _ in batch])
+                start_idx += len(batch)
+                
+                for i, url, delay in working:
+                    filename, idx, _ = batch[i]
+                    working_by_file.setdefault(filename, []).append((idx, url, delay))
+                    working_urls.add(url)
+        
+        self.metrics.set('file_pending_proxies', 0)
+        
+        elapsed = time.time() - start_time
+        if elapsed > 0:
+            print(f"\n⏱️  Чистое время тестирования: {elapsed:.1f} сек")
+            print(f"⚡ Реальная скорость: {len(records)/elapsed:.1f} прокси/сек")
+        return working_by_file
+    
+    def process_files_global(self, input_files):
+        """Общая очередь: строки всех файлов идут в полные пачки,
+        результаты потом раскладываются обратно по исходным файлам"""
+        records, totals = self._collect_records(input_files)
+        
+        print(f"\n{'='*60}")
+        print(f"📚 Общая очередь: {len(records)} прокси из {len(totals)} файлов")
+        print(f"{'='*60}")
+        
+        if not records:
+            print("⚠️  Нет прокси для проверки")
+            return []
+        
+        working_by_file = self._test_records(records)
+        return self._save_all_results(totals, working_by_file)
+    
+    def _save_all_results(self, totals, working_by_file):
+        """Записать out/ по всем файлам; рабочие прокси - в порядке строк исходного файла"""
+        all_working = []
+        for filename, total in totals.items():
+            file_working = [(url, delay) for idx, url, delay in sorted(working_by_file.get(filename, []))]
+            top_groups = {}
+            self._push_top(top_groups, file_working)
+            
+            print(f"\n📄 {filename}")
+            self._save_file_results(filename, total, file_working, top_groups)
+            self.metrics.inc('files_processed_total')
+            all_working.extend(file_working)
+        
+        self.target_latency.clear()
+        self.egress_ips.clear()
+        self.latency_samples.clear()
+        return all_working
+    
+    # ---------- Шардирование между машинами (--shard i/N, --merge) ----------
+    
+    def _canonical_id(self, url):
+        """Стабильная идентичность прокси: разобранный outbound без тега и имени"""
+        config = self.parse_proxy_url(url)
+        if config:
+            config.pop("tag", None)
+            identity = json.dumps(config, sort_keys=True, ensure_ascii=False)
+        else:
+            identity = url.strip().split('#')[0]
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+    
+    def _in_shard(self, url):
+        """С [prune] шард выбирается по общему backend'у: группа целиком попадает
+        в один шард, и отсев по представителям работает как без шардирования"""
+        index, count = self.shard
+        key = self._backend_key(url) if self.prune else None
+        if key is None:
+            digest = self._canonical_id(url)
+        else:
+            digest = hashlib.sha256(json.dumps(key, ensure_ascii=False).encode('utf-8')).hexdigest()
+        return int(digest[:12], 16) % count == index
+    
+    def run_shard(self, files, shard_dir):
+        """Проверить свою долю прокси и записать самоописывающий частичный результат"""
+        index, count = self.shard
+        start_time = time.time()
+        
+        records, totals = self._collect_records([str(file) for file in files if file.is_file()])
+        print(f"\n🧩 Шард {index}/{count}: {len(records)} прокси из {sum(totals.values())}")
+        
+        working_by_file = self._test_records(records) if records else {}
+        
+        partial = {
+            'format': 'proxy-shard',
+            'version': 1,
+            'shard': index,
+            'shards': count,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'elapsed': round(time.time() - start_time, 3),
+            'settings': {'url': self.test_url, 'max_delay': self.max_delay, 'targets': self.targets,
+                         'prune': self.prune},
+            'failed_batches': self.failed_batches,
+            'errors': [[source, protocol, error, count, round(seconds, 3)]
+                       for (source, protocol, error), (count, seconds) in self.error_stats.items()],
+            'retries': self.retry_stats,
+            'files': {
+                filename: {
+                    'total': total,
+                    'tested': sum(1 for record in records if record[0] == filename),
+                    'working': [[idx, url, round(delay, 1)]
+                                for idx, url, delay in sorted(working_by_file.get(filename, []))],
+                    'egress': {url: self.egress_ips[url] for idx, url, delay in working_by_file.get(filename, [])
+                               if url in self.egress_ips},
+                    'targets': {url: self.target_latency[url] for idx, url, delay in working_by_file.get(filename, [])
+                                if url in self.target_latency},
+                    'latency': {url: self.latency_samples[url] for idx, url, delay in working_by_file.get(filename, [])
+                                if url in self.latency_samples},
+                }
+                for filename, total in totals.items()
+            },
+        }
+        
+        os.makedirs(shard_dir, exist_ok=True)
+        shard_file = os.path.join(shard_dir, f"shard_{index}_of_{count}.json")
+        tmp_path = shard_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(partial, f, ensure_ascii=False)
+        os.replace(tmp_path, shard_file)
+        
+        print(f"💾 Частичный результат: {shard_file}")
+        return shard_file
+    
+    def merge_shards(self, shard_files):
+        """Собрать частичные результаты шардов в обычные out/, статистику и отчёт"""
+        partials = []
+        for path in shard_files:
+            with open(path, 'r', encoding='utf-8') as f:
+                partial = json.load(f)
+            if partial.get('format') != 'proxy-shard':
+                print(f"⚠️  Не файл шарда: {path}")
+                continue
+            partials.append(partial)
+        
+        if not partials:
+            print("❌ Нет частичных результатов для объединения")
+            return []
+        
+        count = partials[0]['shards']
+        seen = {p['shard'] for p in partials if p['shards'] == count}
+        if len(partials) != len(seen) or any(p['shards'] != count for p in partials):
+            print("⚠️  Шарды из разных запусков или повторяются")
+        if len({p.get('settings', {}).get('prune', False) for p in partials}) > 1:
+            # С prune и без него прокси делятся между шардами по-разному - возможны пропуски и повторы
+            print("⚠️  Шарды запущены с разными [prune] enabled - результат может быть неполным")
+        missing = sorted(set(range(count)) - seen)
+        if missing:
+            print(f"⚠️  Нет шардов: {missing} - результат будет неполным")
+        
+        totals = {}
+        working_by_file = {}
+        for partial in partials:
+            for filename, data in partial['files'].items():
+                totals[filename] = max(totals.get(filename, 0), data['total'])
+                working_by_file.setdefault(filename, []).extend(
+                    (idx, url, delay) for idx, url, delay in data['working'])
+                self.egress_ips.update(data.get('egress', {}))
+                self.target_latency.update(data.get('targets', {}))
+                self.latency_samples.update(data.get('latency', {}))
+        
+        print(f"🧩 Объединяю {len(partials)}/{count} шардов, файлов: {len(totals)}")
+        
+        self._reset_archive()
+        all_working = self._save_all_results(totals, working_by_file)
+        for partial in partials:
+            self.failed_batches.extend(f"{partial['shard']}:{num}" for num in partial.get('failed_batches', []))
+            for source, protocol, error, count, seconds in partial.get('errors', []):
+                entry = self.error_stats.setdefault((source, protocol, error), [0, 0.0])
+                entry[0] += count
+                entry[1] += seconds
+            for error, (count, rescued) in partial.get('retries', {}).items():
+                entry = self.retry_stats.setdefault(error, [0, 0])
+                entry[0] += count
+                entry[1] += rescued
+        
+        self._print_summary(max(p.get('elapsed', 0) for p in partials))
+        self._write_error_stats()
+        self.send_telegram_report()
+        self.wait_uploads()
+        return all_working
+    
+    def _save_file_results(self, filename, total, all_working, top_groups):
+        """Статистика и файлы out/ для одного исходного файла"""
+        if self.egress and self.egress_dedupe:
+            all_working = self._collapse_egress(all_working)
+            top_groups = {}
+            self._push_top(top_groups, all_working)
+        self.stats[filename] = {'total': total, 'working': len(all_working)}
         
         # Сохраняем результаты
         if all_working:
@@ -619,40 +2013,272 @@ class FastProxyTester:
             print(f"📁 Полный путь: {os.path.abspath(output_file)}")
             
             with open(output_file, 'w', encoding='utf-8') as f:
-                f.write('\n'.join(all_working))
+                f.write('\n'.join(url for url, delay in all_working))
                 print ( "saved" )
+            
+            self._append_to_archive(output_file)
+            
+            if self.targets:
+                targets_file = f"out/targets_{os.path.splitext(filename)[0]}.json"
+                with open(targets_file, 'w', encoding='utf-8') as f:
+                    json.dump({url: self.target_latency.get(url) for url, delay in all_working},
+                              f, ensure_ascii=False, indent=1)
+                self._append_to_archive(targets_file)
+            
+            if self.latency_samples:
+                latency_file = f"out/latency_{os.path.splitext(filename)[0]}.json"
+                with open(latency_file, 'w', encoding='utf-8') as f:
+                    json.dump({url: self.latency_samples.get(url) for url, delay in all_working},
+                              f, ensure_ascii=False, indent=1)
+                self._append_to_archive(latency_file)
+            
+            if self.egress:
+                egress_file = f"out/egress_{os.path.splitext(filename)[0]}.json"
+                groups = self._egress_groups(all_working)
+                with open(egress_file, 'w', encoding='utf-8') as f:
+                    json.dump(groups, f, ensure_ascii=False, indent=1)
+                self._append_to_archive(egress_file)
+                print(f"🌐 {egress_file}: {len(groups)} выходных IP на {len(all_working)} рабочих")
+            
+            for group, top in sorted(top_groups.items()):
+                top_file = f"out/top_{filename}" if group is None else f"out/top_{group}_{filename}"
+                ranked = top.ranked()
+                with open(top_file, 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(url for url, delay in ranked))
+                self._append_to_archive(top_file)
+                print(f"🏁 {top_file}: {len(ranked)} лучших, {ranked[0][1]:.0f}-{ranked[-1][1]:.0f}ms")
+            
+            if self.export_singbox:
+                client_file = f"out/singbox_{os.path.splitext(filename)[0]}.json"
+                count = self._write_client_config(client_file, all_working)
+                self._append_to_archive(client_file)
+                print(f"📦 {client_file}: конфиг sing-box, {count} прокси в urltest")
                 
-            print(f"\n💾 Сохранено: {len(all_working)}/{len(lines)}")
+            print(f"\n💾 Сохранено: {len(all_working)}/{total}")
             print(f"📁 Файл: {output_file}")
         else:
             print(f"\n⚠️  Нет рабочих прокси")
+    
+    
+    
+    def _egress_groups(self, working):
+        """Рабочие прокси по выходному IP, внутри - от быстрых к медленным"""
+        groups = {}
+        for url, delay in sorted(working, key=lambda item: item[1]):
+            ip = self.egress_ips.get(url, 'unknown')
+            groups.setdefault(ip, []).append({'url': url, 'delay': round(delay, 1)})
+        return groups
+    
+    def _collapse_egress(self, working):
+        """Один прокси на выходной IP - самый быстрый; прокси без IP остаются все.
+        Порядок строк исходного файла сохраняется"""
+        fastest = {}
+        for url, delay in working:
+            ip = self.egress_ips.get(url)
+            if ip and (ip not in fastest or delay < fastest[ip][1]):
+                fastest[ip] = (url, delay)
+        keep = {url for url, delay in fastest.values()}
+        collapsed = [(url, delay) for url, delay in working if url in keep or url not in self.egress_ips]
+        if len(collapsed) < len(working):
+            print(f"🌐 Одинаковый выход: оставлено {len(collapsed)} из {len(working)}")
+        return collapsed
+    
+    def _group_keys(self, urls):
+        """Ключ группы для top-K: None, протокол или код страны сервера"""
+        if self.group_by == 'protocol':
+            return [url.split('://', 1)[0].lower() for url in urls]
+        if self.group_by == 'country':
+            # Страна выхода, если выходной IP известен: у прокси за CDN она не совпадает с сервером
+            hosts = [self.egress_ips.get(url) or urlparse(url.split('#')[0]).hostname or '' for url in urls]
+            self._lookup_countries(hosts)
+            return [self._country_cache.get(host, 'XX') for host in hosts]
+        return [None] * len(urls)
+    
+    def _lookup_countries(self, hosts):
+        """Страна по адресу сервера или выходному IP (ip-api.com batch, с кэшем на весь запуск)"""
+        import requests
+        pending = {}
+        for host in set(hosts):
+            if host in self._country_cache:
+                continue
+            try:
+                pending[host] = socket.gethostbyname(host)
+            except OSError:
+                self._country_cache[host] = 'XX'
         
-        return all_working
+        items = list(pending.items())
+        for start in range(0, len(items), 100):
+            chunk = items[start:start + 100]
+            try:
+                response = requests.post(
+                    'http://ip-api.com/batch?fields=countryCode,query',
+                    json=sorted({ip for _, ip in chunk}),
+                    timeout=5
+                )
+                by_ip = {row.get('query'): row.get('countryCode') or 'XX' for row in response.json()}
+            except Exception:
+                by_ip = {}
+            for host, ip in chunk:
+                self._country_cache[host] = by_ip.get(ip, 'XX')
     
+    def _reset_archive(self):
+        """Начать новый архив результатов для текущего запуска"""
+        import zipfile
+        os.makedirs('out', exist_ok=True)
+        with self._archive_lock:
+            with zipfile.ZipFile(self.zip_path, 'w'):
+                pass
+            self._archived = {}
     
+    def _append_to_archive(self, file_path):
+        """Дописать готовый файл результатов в архив (вызывается после каждого файла)"""
+        import zipfile
+        name = os.path.basename(file_path)
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        
+        with self._archive_lock:
+            if name in self._archived:
+                # Повторная запись того же имени - пересобираем архив без старой копии
+                self._rebuild_archive(exclude=name)
+            with zipfile.ZipFile(self.zip_path, 'a', compression=zipfile.ZIP_DEFLATED,
+                                 compresslevel=self.zip_level) as zipf:
+                zipf.writestr(name, data)
+            self._archived[name] = hashlib.sha256(data).hexdigest()
+    
+    def _rebuild_archive(self, exclude):
+        """Пересобрать архив, выкинув одну запись (вызывается под _archive_lock)"""
+        import zipfile
+        with zipfile.ZipFile(self.zip_path, 'r') as src:
+            entries = [(info.filename, src.read(info.filename)) for info in src.infolist()
+                       if info.filename != exclude]
+        with zipfile.ZipFile(self.zip_path, 'w', compression=zipfile.ZIP_DEFLATED,
+                             compresslevel=self.zip_level) as zipf:
+            for name, data in entries:
+                zipf.writestr(name, data)
+    
+    def _load_tg_state(self):
+        try:
+            with open(self.tg_state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return {}
+    
+    def _save_tg_state(self, state):
+        tmp_path = self.tg_state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.tg_state_path)
     
     def send_telegram_report(self):
-        """Отправка архива с результатами в Telegram"""
+        """Поставить архив с результатами в очередь на отправку в Telegram"""
         if not self.bot_token or not self.chat_id:
             print("⚠️  Telegram токены не настроены")
             return
         
-        # Создаём архив
-        import zipfile
-        zip_path = 'out/results.zip'
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for file in Path('out').glob('*'):
-                if file.is_file() and file.suffix != '.zip':
-                    zipf.write(file, file.name)
+        with self._archive_lock:
+            current = dict(self._archived)
         
-        # Отправляем
-        url = f"https://api.telegram.org/bot{self.bot_token}/sendDocument"
-        with open(zip_path, 'rb') as f:
-            files = {'document': f}
-            data = {'chat_id': self.chat_id, 'caption': f"✅ Результаты: {len(self.stats)} файлов"}
-            requests.post(url, files=files, data=data)
+        if not current:
+            print("⚠️  Нет файлов для отправки")
+            return
         
-        print("📤 Архив отправлен в Telegram")
+        previous = self._load_tg_state().get('files', {})
+        changed = [name for name, digest in current.items() if previous.get(name) != digest]
+        
+        if not changed:
+            print("📭 Результаты не изменились с прошлого отчёта, отправка пропущена")
+            return
+        
+        caption = f"✅ Результаты: {len(self.stats)} файлов"
+        
+        if self.tg_delta and previous and len(changed) < len(current):
+            # Изменилась только часть файлов - дельта собирается в памяти, на диске ничего не остаётся
+            import zipfile
+            buffer = io.BytesIO()
+            with self._archive_lock:
+                with zipfile.ZipFile(self.zip_path, 'r') as src, \
+                        zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED,
+                                        compresslevel=self.zip_level) as dst:
+                    for name in changed:
+                        dst.writestr(name, src.read(name))
+            document = ('results_delta.zip', buffer.getvalue())
+            caption += f" (изменено: {len(changed)})"
+        else:
+            document = self.zip_path
+        
+        new_state = {'files': {**previous, **current}, 'sent_at': time.time()}
+        self._upload_queue.put((document, caption, new_state))
+        
+        if self._upload_thread is None:
+            self._upload_thread = threading.Thread(target=self._upload_worker, daemon=True)
+            self._upload_thread.start()
+        
+        print(f"📤 Архив поставлен в очередь на отправку ({len(changed)} изм.)")
+    
+    def _upload_worker(self):
+        """Фоновая отправка документов в Telegram"""
+        while True:
+            job = self._upload_queue.get()
+            try:
+                if job is None:
+                    return
+                document, caption, new_state = job
+                if self._upload_document(document, caption):
+                    self._save_tg_state(new_state)
+                    print("📤 Архив отправлен в Telegram")
+            finally:
+                self._upload_queue.task_done()
+    
+    def _upload_document(self, document, caption):
+        """sendDocument с таймаутом, повторами и экспоненциальной паузой.
+        document - путь к файлу или (имя, байты) для архива из памяти"""
+        import requests
+        url = f"{self.tg_api_url}/bot{self.bot_token}/sendDocument"
+        
+        for attempt in range(self.tg_retries + 1):
+            delay = self.tg_backoff * (2 ** attempt) * (0.5 + random.random() / 2)
+            try:
+                if isinstance(document, str):
+                    name, f = os.path.basename(document), open(document, 'rb')
+                else:
+                    name, f = document[0], io.BytesIO(document[1])
+                with f:
+                    response = requests.post(
+                        url,
+                        files={'document': (name, f)},
+                        data={'chat_id': self.chat_id, 'caption': caption},
+                        timeout=self.tg_timeout
+                    )
+                if response.status_code == 200:
+                    return True
+                if response.status_code == 429:
+                    # Telegram сообщает сколько ждать
+                    try:
+                        delay = response.json()['parameters']['retry_after']
+                    except Exception:
+                        pass
+                elif response.status_code < 500:
+                    print(f"❌ Telegram: HTTP {response.status_code} {response.text[:200]}")
+                    return False
+                last_error = f"HTTP {response.status_code}"
+            except requests.exceptions.RequestException as e:
+                last_error = type(e).__name__
+            
+            if attempt < self.tg_retries:
+                print(f"⚠️  Telegram: {last_error}, повтор через {delay:.1f}с")
+                time.sleep(delay)
+        
+        print(f"❌ Не удалось отправить в Telegram: {last_error}")
+        return False
+    
+    def wait_uploads(self, timeout=None):
+        """Дождаться завершения фоновой отправки"""
+        if self._upload_thread is None:
+            return
+        self._upload_queue.put(None)
+        self._upload_thread.join(timeout)
+        self._upload_thread = None
     
     
     def run(self):
@@ -661,8 +2287,18 @@ class FastProxyTester:
         print(f"📊 Потоков: {self.threads}")
         print(f"📦 Размер пачки: {self.batch_size}")
         print(f"🌐 Тестовый URL: {self.test_url}")
+        if self.backend == 'clash':
+            print("🧪 Бэкенд: Clash API sing-box (targets и hedge не используются)")
+        if self.targets:
+            print(f"🎯 Целей: {len(self.targets)}, нужно пройти: {self.targets_required}")
         print(f"⏱️  Таймаут: {self.max_delay}мс")
         print(f"🔄 Попыток: {self.attempts}")
+        if self.samples > 1:
+            print(f"📐 Замеров задержки: до {self.samples} после прогрева (медиана, останов при z = {self.samples_z:g})")
+        if self.retry_never or self.retry_attempts:
+            per_class = ', '.join(f"{error}:{count}" for error, count in self.retry_attempts.items())
+            print(f"🔁 Без повтора: {', '.join(sorted(self.retry_never)) or '-'}"
+                  f"{f'; по классам: {per_class}' if per_class else ''}")
         
         #  Проверяем sing-box
         if not os.path.exists(self.singbox_path):
@@ -681,16 +2317,37 @@ class FastProxyTester:
             print("\n⚠️  Нет файлов в папке 'in'")
             return
         
+        self.start_metrics()
+        self._load_history_scores()
+        
+        if self.shard is not None:
+            self.run_shard(files, self.shard_dir)
+            self._finish_history()
+            self._write_profile()
+            return
+        
         start_time = time.time()
+        self._reset_archive()
         
         all_working = []
-        for file in files:
-            if file.is_file():
-                working = self.process_file(str(file))
-                all_working.extend(working)
+        if self.global_queue:
+            all_working = self.process_files_global([str(file) for file in files if file.is_file()])
+        else:
+            for file in files:
+                if file.is_file():
+                    working = self.process_file(str(file))
+                    all_working.extend(working)
         
         elapsed_time = time.time() - start_time
+        self._print_summary(elapsed_time)
+        self._write_error_stats()
+        self._finish_history()
         
+        self.send_telegram_report()
+        self.wait_uploads()
+        self._write_profile()
+    
+    def _print_summary(self, elapsed_time):
         # Статистика
         print(f"\n{'='*60}")
         print("📊 ИТОГИ:")
@@ -705,7 +2362,8 @@ class FastProxyTester:
         
         print(f"\n✅ Всего рабочих: {working_all}/{total_all}")
         print(f"⏱️  Общее время: {elapsed_time:.1f} секунд")
-        print(f"⚡ Скорость: {total_all/elapsed_time:.2f} прокси/сек")
+        if elapsed_time > 0:
+            print(f"⚡ Скорость: {total_all/elapsed_time:.2f} прокси/сек")
         
         
         
@@ -716,10 +2374,127 @@ class FastProxyTester:
             print(f"\n⚠️  Сбойных пачек: {len(self.failed_batches)}")
             print(f"📋 Номера: {sorted(set(self.failed_batches))}")
         
-        print(f"{'='*60}")
+        by_class = self._error_totals(lambda source, protocol, error: error)
+        if by_class:
+            total_seconds = sum(seconds for count, seconds in by_class.values()) or 1
+            print(f"\n🧾 Время проверок по классам:")
+            for error, (count, seconds) in sorted(by_class.items(), key=lambda x: -x[1][1]):
+                print(f"   {error:<22}{count:>7}{seconds:>10.1f} сек{seconds / total_seconds * 100:>7.1f}%")
+        
+        if self.retry_stats:
+            print(f"\n🔁 Повторы по классам (повторов / заработало):")
+            for error, (count, rescued) in sorted(self.retry_stats.items(), key=lambda x: -x[1][0]):
+                share = rescued / count * 100 if count else 0
+                print(f"   {error:<22}{count:>7}{rescued:>7}{share:>8.1f}%")
         
-        self.send_telegram_report()  
+        print(f"{'='*60}")
+    
+    def _error_totals(self, key):
+        """Свернуть error_stats по ключу key(файл, протокол, класс) -> [проверок, секунд]"""
+        totals = {}
+        for (source, protocol, error), (count, seconds) in self.error_stats.items():
+            entry = totals.setdefault(key(source, protocol, error), [0, 0.0])
+            entry[0] += count
+            entry[1] += seconds
+        return totals
+    
+    def _write_error_stats(self, path='out/errors.json'):
+        """Количество и время проверок по классам: всего, по файлам и по протоколам"""
+        if not self.error_stats:
+            return
+        nested = {'by_file': {}, 'by_protocol': {}}
+        for (source, protocol, error), (count, seconds) in self.error_stats.items():
+            for group, name in (('by_file', source), ('by_protocol', protocol)):
+                entry = nested[group].setdefault(name, {}).setdefault(error, {'count': 0, 'seconds': 0.0})
+                entry['count'] += count
+                entry['seconds'] = round(entry['seconds'] + seconds, 3)
+        nested['by_class'] = {
+            error: {'count': count, 'seconds': round(seconds, 3)}
+            for error, (count, seconds) in self._error_totals(lambda source, protocol, error: error).items()
+        }
+        nested['retries'] = {
+            error: {'retries': count, 'rescued': rescued}
+            for error, (count, rescued) in self.retry_stats.items()
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(nested, f, ensure_ascii=False, indent=1)
+        # В архив попадают только явно добавленные файлы - без этого отчёт не уйдёт в Telegram
+        self._append_to_archive(path)
+        print(f"🧾 Классы ошибок: {path}")
+    
+    def _write_profile(self):
+        if self.profiler.enabled:
+            print("\n🔬 ПРОФИЛЬ СТАДИЙ:")
+            print(self.profiler.summary())
+            for path in self.profiler.write(self.profile_dir):
+                print(f"📁 {path}")
 
-if __name__ == '__main__':
-    tester = FastProxyTester()
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Быстрое пакетное тестирование прокси через sing-box')
+    parser.add_argument('--config', default='option.ini', help='файл настроек')
+    parser.add_argument('--profile', action='store_true',
+                        help='замерять wall/CPU время по стадиям каждой пачки')
+    parser.add_argument('--profile-python', action='store_true',
+                        help='дополнительно снимать cProfile основного потока')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='дополнительно отслеживать память через tracemalloc')
+    parser.add_argument('--profile-dir', default='profile',
+                        help='куда писать trace.json и сводку профиля')
+    parser.add_argument('--shard', metavar='i/N',
+                        help='проверить только шард i из N (i от 0 до N-1), результат - в --shard-dir')
+    parser.add_argument('--shard-dir', default='shards',
+                        help='папка частичных результатов шардов')
+    parser.add_argument('--merge', nargs='*', metavar='FILE',
+                        help='объединить частичные результаты (по умолчанию все из --shard-dir)')
+    parser.add_argument('--daemon', action='store_true',
+                        help='режим демона: перепроверять пул по кругу и отдавать его по HTTP ([daemon])')
+    parser.add_argument('--cycles', type=int, default=0,
+                        help='для --daemon: остановиться после N циклов (0 - работать до Ctrl+C)')
+    args = parser.parse_args(argv)
+    
+    if args.shard:
+        try:
+            index, count = (int(part) for part in args.shard.split('/'))
+            if count < 1 or not 0 <= index < count:
+                raise ValueError
+        except ValueError:
+            parser.error('--shard ожидает i/N, где 0 <= i < N')
+        args.shard = (index, count)
+    return args
+ 
+def main(argv=None):
+    args = parse_args(argv)
+    
+    profiler = StageProfiler(
+        enabled=args.profile or args.profile_python or args.profile_memory,
+        cprofile=args.profile_python,
+        trace_memory=args.profile_memory
+    )
+    profiler.start()
+    
+    tester = FastProxyTester(args.config, profiler=profiler)
+    tester.profile_dir = args.profile_dir
+    tester.shard = args.shard
+    tester.shard_dir = args.shard_dir
+    if args.shard:
+        index, count = args.shard
+        tester.port_span = tester.port_span // count
+        tester.port_base += index * tester.port_span
+    
+    if args.merge is not None:
+        shard_files = args.merge or sorted(str(p) for p in Path(args.shard_dir).glob('shard_*.json'))
+        tester.merge_shards(shard_files)
+        return
+    
+    if args.daemon:
+        from daemon import PoolDaemon
+        PoolDaemon(tester).run(args.cycles)
+        tester._write_profile()
+        return
+    
     tester.run()
+ 
+if __name__ == '__main__':
+    main()